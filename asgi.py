@@ -0,0 +1,278 @@
+"""
+This module is an ASGI entry point for the PasswordAsAService web API, for serving from an asyncio event loop
+under an ASGI server, e.g. "uvicorn asgi:app".
+
+Full listings and single user/group lookups are answered on the loop straight from the cached JSON bodies.
+Every other request runs the Flask app in an executor thread, so all routes keep the same JSON contract.
+File reloads never run on the loop: the first load runs in the executor, then the file watcher thread reloads.
+"""
+
+
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import io
+import re
+import sys
+import threading
+import time
+
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import http_date, parse_accept_header, parse_date, parse_etags
+
+import service
+
+try:
+    import uvicorn
+except ImportError:
+    uvicorn = None  # Only needed to run this module as a script.
+
+
+# Set global ASGI variables.
+executor_threads = 64  # Threads for Flask requests (including long-polls) and file loads.
+executor = ThreadPoolExecutor(max_workers=executor_threads, thread_name_prefix='asgi')
+watcher_lock = threading.Lock()
+single_route = re.compile(r'/(users|groups)/([0-9]+)')
+
+
+async def app(scope, receive, send):
+    """ASGI application serving the API."""
+
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+
+    # Servers without lifespan support load the files on the first request instead.
+    start = time.perf_counter()
+    if service.watch_files and not service.watcher_running():
+        await run_blocking(start_watcher)
+
+    if not await serve_cached(scope, send, start):
+        await serve_wsgi(scope, receive, send)
+
+
+async def lifespan(receive, send):
+    """Load both files and start the file watcher on server startup, stop the watcher on shutdown."""
+
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            if service.watch_files:
+                await run_blocking(start_watcher)
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await run_blocking(service.stop_watcher)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+def start_watcher():
+    """Start the file watcher unless it is already running. Reads both files, so call it in the executor."""
+
+    with watcher_lock:
+        if not service.watcher_running():
+            service.start_watcher()
+
+
+async def run_blocking(func, *args):
+    """Run func(*args) in the executor and return its result."""
+
+    return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+
+
+async def serve_cached(scope, send, start):
+    """
+    Answer a plain GET of a full listing or a found user/group from the cached JSON, with the same
+    headers and 304 handling as the Flask app. Return False, sending nothing, for any other request.
+    Only used while the file watcher is running, as the current snapshots are then always up to date.
+    """
+
+    if scope['method'] != 'GET' or scope['query_string'] or not service.watcher_running():
+        return False
+    path = request_path(scope)
+    found = find_cached(path)
+    if found is None:
+        return False
+    rule, snapshot, position = found
+
+    # Leave NDJSON streaming, other wire formats and profiled requests to Flask.
+    headers = request_headers(scope)
+    if 'x-profile' in headers and service.profile_token is not None:
+        return False
+    accept = headers.get('accept', '')
+    if accept and service.choose_format(MIMEAccept(parse_accept_header(accept)), rule) != 'json':
+        return False
+
+    # Work out the caching headers; If-None-Match takes precedence over If-Modified-Since.
+    encoding = service.choose_encoding(headers.get('accept-encoding', ''))
+    etag = service.etag_for([snapshot], path, (), accept, encoding)
+    modified = service.last_modified([snapshot])
+    if_none_match = parse_etags(headers.get('if-none-match'))
+    if if_none_match:
+        not_modified = if_none_match.contains(etag)
+    else:
+        if_modified_since = parse_date(headers.get('if-modified-since'))
+        not_modified = if_modified_since is not None and modified <= if_modified_since
+    version_header = b'x-users-version' if rule.startswith('/users') else b'x-groups-version'
+    response_headers = [(b'etag', '"{0}"'.format(etag).encode()),
+                        (b'cache-control', service.cache_control.encode()),
+                        (b'vary', b'Accept, Accept-Encoding'),
+                        (version_header, str(snapshot.version).encode())]
+
+    if not_modified:
+        status = 304
+        body = b''
+    else:
+        status = 200
+        body, encoding = service.encoded_body(snapshot, position, encoding)
+        response_headers[:0] = [(b'content-type', b'application/json'),
+                                (b'content-length', str(len(body)).encode()),
+                                (b'last-modified', http_date(modified).encode())]
+        if encoding:
+            response_headers.append((b'content-encoding', encoding.encode()))
+    await send({'type': 'http.response.start', 'status': status, 'headers': response_headers})
+    await send({'type': 'http.response.body', 'body': body})
+    service.record_route(rule, 'GET', status, start)
+
+    return True
+
+
+def find_cached(path):
+    """
+    Return (route rule, snapshot, row position or None for the listing) for a full listing or single
+    user/group path, or None.
+    None also covers users/groups that aren't found and unreadable files, so Flask builds the error response.
+    """
+
+    if path == '/users':
+        rule, snapshot = '/users', service.user_snapshot
+    elif path == '/groups':
+        rule, snapshot = '/groups', service.group_snapshot
+    else:
+        match = single_route.fullmatch(path)
+        if match is None:
+            return None
+        if match.group(1) == 'users':
+            rule, snapshot, col = '/users/<int:uid>', service.user_snapshot, 'uid'
+        else:
+            rule, snapshot, col = '/groups/<int:gid>', service.group_snapshot, 'gid'
+        if snapshot.error or snapshot.file_time is None:
+            return None
+        found = service.lookup(snapshot.index[col], int(match.group(2)))
+        if not found:
+            return None
+        return rule, snapshot, found[0]
+
+    if snapshot.error or snapshot.file_time is None:
+        return None
+    return rule, snapshot, None
+
+
+async def serve_wsgi(scope, receive, send):
+    """Answer a request with the Flask app, running it and each chunk of its response in the executor."""
+
+    environ = wsgi_environ(scope, await read_body(receive))
+    started = []
+    written = []
+
+    def start_response(status, headers, exc_info=None):
+        started[:] = [int(status.split(' ', 1)[0]), headers]
+        return written.append
+
+    chunks = await run_blocking(service.app, environ, start_response)
+    try:
+        status, headers = started
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]})
+        for chunk in written:
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+
+        # Streamed responses build each chunk as it is read, so read them off the loop too.
+        iterator = iter(chunks)
+        while True:
+            chunk = await run_blocking(next, iterator, None)
+            if chunk is None:
+                break
+            if chunk:
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+async def read_body(receive):
+    """Return the whole request body."""
+
+    parts = []
+    while True:
+        message = await receive()
+        if message['type'] != 'http.request':
+            break
+        parts.append(message.get('body', b''))
+        if not message.get('more_body', False):
+            break
+
+    return b''.join(parts)
+
+
+def request_path(scope):
+    """Return the request path below the app's root path."""
+
+    path = scope['path']
+    root_path = scope.get('root_path', '')
+    if root_path and path.startswith(root_path):
+        path = path[len(root_path):]
+
+    return path
+
+
+def request_headers(scope):
+    """Return the request headers as {lowercase name: value}, joining repeated headers with commas."""
+
+    headers = {}
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').lower()
+        value = value.decode('latin-1')
+        headers[name] = headers[name] + ',' + value if name in headers else value
+
+    return headers
+
+
+def wsgi_environ(scope, body):
+    """Return a WSGI environ for an ASGI HTTP request scope and its body."""
+
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client')
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode().decode('latin-1'),
+        'PATH_INFO': request_path(scope).encode().decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'REMOTE_ADDR': client[0] if client else '',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in request_headers(scope).items():
+        name = name.upper().replace('-', '_')
+        if name not in ['CONTENT_TYPE', 'CONTENT_LENGTH']:
+            name = 'HTTP_' + name
+        environ[name] = value
+    environ['CONTENT_LENGTH'] = str(len(body))  # The whole body has been read, whatever the framing was.
+
+    return environ
+
+
+if __name__ == '__main__':
+    if uvicorn is None:
+        sys.exit('Install uvicorn, or run asgi:app under another ASGI server.')
+    uvicorn.run(app, host='127.0.0.1', port=5000)
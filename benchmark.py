@@ -0,0 +1,471 @@
+"""
+This script benchmarks the PasswordAsAService web API against synthetic passwd and group files.
+It generates files of the requested size, then drives every API route (but the admin-only /profiles
+ones) through the Flask test client, a real WSGI server and the ASGI app (in process, and under uvicorn
+if it is installed), and reports latency percentiles, throughput, reload time and peak RSS. It also compares the size,
+serialization time and client decode time of the full user listing in each wire format.
+
+Results can be saved as JSON and compared against a saved baseline to catch performance regressions.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+import argparse
+import asyncio
+import http.client
+import json
+import os
+import random
+import resource
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+import asgi
+import service
+
+try:
+    import uvicorn
+except ImportError:
+    uvicorn = None  # The uvicorn target is skipped without it.
+
+
+shells = ['/bin/bash', '/bin/sh', '/bin/zsh', '/usr/sbin/nologin', '/bin/false']
+source_name = 'bench'  # Source serving the same files, for the /sources routes.
+
+
+def generate_files(directory, users, groups, members, seed=0):
+    """Write synthetic passwd and group files to directory. Return (user file, group file)."""
+
+    rand = random.Random(seed)
+    user_file = os.path.join(directory, 'passwd')
+    group_file = os.path.join(directory, 'group')
+
+    with open(user_file, 'w') as passwd:
+        for i in range(users):
+            passwd.write('user{0}:x:{1}:{2}:User {0}:/home/user{0}:{3}\n'.format(
+                i, 1000 + i, 1000 + i % max(groups, 1), rand.choice(shells)))
+
+    with open(group_file, 'w') as group:
+        for i in range(groups):
+            count = rand.randint(0, min(members, users))
+            names = ','.join('user{0}'.format(j) for j in rand.sample(range(users), count))
+            group.write('group{0}:x:{1}:{2}\n'.format(i, 1000 + i, names))
+
+    return user_file, group_file
+
+
+def get_routes(users, groups, versions=(0, 0)):
+    """
+    Return a list of (name, path, headers, JSON body or None for GET) covering every API route but
+    the admin-only /profiles routes. versions are the loaded (user, group) file versions, for the change feeds.
+    """
+
+    uid = 1000 + users // 2
+    gid = 1000 + groups // 2
+    name = 'user{0}'.format(users // 2)
+
+    batch_uids = [1000 + i for i in range(0, users, max(users // 1000, 1))]
+    batch_gids = [1000 + i for i in range(0, groups, max(groups // 1000, 1))]
+
+    return [
+        ('users_all', '/users', {}, None),
+        ('users_all_stream', '/users?stream=1', {}, None),
+        ('users_all_gzip', '/users', {'Accept-Encoding': 'gzip'}, None),
+        ('users_all_columns', '/users', {'Accept': service.columns_mimetype}, None),
+        ('users_all_msgpack', '/users', {'Accept': service.msgpack_mimetype}, None),
+        ('users_all_ndjson', '/users', {'Accept': 'application/x-ndjson'}, None),
+        ('users_all_page', '/users?' + urlencode({'limit': 100, 'offset': users // 2}), {}, None),
+        ('users_query_uid', '/users/query?' + urlencode({'uid': uid}), {}, None),
+        ('users_query_shell', '/users/query?' + urlencode({'shell': '/bin/zsh'}), {}, None),
+        ('users_query_shell_page', '/users/query?' + urlencode({'shell': '/bin/zsh', 'limit': 100}), {}, None),
+        ('users_page_expand', '/users?' + urlencode({'limit': 100, 'expand': 'groups'}), {}, None),
+        ('users_single', '/users/{0}'.format(uid), {}, None),
+        ('users_single_expand', '/users/{0}?expand=groups&primary_group=1'.format(uid), {}, None),
+        ('users_groups', '/users/{0}/groups'.format(uid), {}, None),
+        ('users_batch', '/users/batch', {}, {'uids': batch_uids}),
+        ('users_changes', '/users/changes?' + urlencode({'since': versions[0]}), {}, None),
+        ('groups_all', '/groups', {}, None),
+        ('groups_all_gzip', '/groups', {'Accept-Encoding': 'gzip'}, None),
+        ('groups_query_gid', '/groups/query?' + urlencode({'gid': gid}), {}, None),
+        ('groups_query_member', '/groups/query?' + urlencode({'member': name}), {}, None),
+        ('groups_single', '/groups/{0}'.format(gid), {}, None),
+        ('groups_batch', '/groups/batch', {}, {'gids': batch_gids, 'uids': batch_uids}),
+        ('groups_changes', '/groups/changes?' + urlencode({'since': versions[1]}), {}, None),
+        ('sources', '/sources', {}, None),
+        ('source_users_single', '/sources/{0}/users/{1}'.format(source_name, uid), {}, None),
+        ('source_users_query_shell', '/sources/{0}/users/query?'.format(source_name) + urlencode({'shell': '/bin/zsh'}),
+         {}, None),
+        ('source_groups_single', '/sources/{0}/groups/{1}'.format(source_name, gid), {}, None),
+        ('users_sources', '/users/{0}/sources'.format(uid), {}, None),
+        ('metrics', '/metrics', {}, None),
+    ]
+
+
+class TestClientTarget:
+    """Sends requests through the Flask test client, in process."""
+
+    name = 'test_client'
+
+    def __init__(self):
+        self.local = threading.local()
+
+    def send(self, path, headers, body):
+        if not hasattr(self.local, 'client'):
+            self.local.client = service.app.test_client()
+        # Buffered, so each response is closed like a server would, giving back its admission capacity.
+        if body is None:
+            response = self.local.client.get(path, headers=headers, buffered=True)
+        else:
+            response = self.local.client.post(path, headers=headers, json=body, buffered=True)
+        return response.status_code, len(response.data)
+
+    def close(self):
+        pass
+
+
+class ASGITarget:
+    """Sends requests straight to the ASGI app, on an event loop in a background thread, in process."""
+
+    name = 'asgi'
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    def send(self, path, headers, body):
+        method, data = ('GET', b'') if body is None else ('POST', json.dumps(body).encode())
+        if body is not None:
+            headers = dict(headers, **{'Content-Type': 'application/json'})
+        future = asyncio.run_coroutine_threadsafe(call_asgi(method, path, headers, data), self.loop)
+        status, _, response_body = future.result()
+        return status, len(response_body)
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        service.stop_watcher()  # Started by the first request.
+
+
+async def call_asgi(method, path, headers, body=b''):
+    """Send one HTTP request to the ASGI app. Return (status, {lowercase header: value}, body)."""
+
+    path, _, query = path.partition('?')
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': method,
+        'scheme': 'http', 'path': path, 'raw_path': path.encode(), 'query_string': query.encode(),
+        'root_path': '', 'headers': [(name.lower().encode(), value.encode()) for name, value in headers.items()],
+        'client': ('127.0.0.1', 0), 'server': ('127.0.0.1', 80),
+    }
+    messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+    response = {'headers': {}, 'body': []}
+
+    async def receive():
+        return messages.pop(0) if messages else {'type': 'http.disconnect'}
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            response['status'] = message['status']
+            response['headers'] = {name.decode(): value.decode() for name, value in message['headers']}
+        else:
+            response['body'].append(message.get('body', b''))
+
+    await asgi.app(scope, receive, send)
+    return response['status'], response['headers'], b''.join(response['body'])
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    """WSGI request handler that doesn't log each request."""
+
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+class HTTPTarget:
+    """Sends HTTP requests to a server on a local port, set by subclasses."""
+
+    port = None
+
+    def send(self, path, headers, body):
+        connection = http.client.HTTPConnection('127.0.0.1', self.port)
+        try:
+            if body is None:
+                connection.request('GET', path, headers=headers)
+            else:
+                headers = dict(headers, **{'Content-Type': 'application/json'})
+                connection.request('POST', path, body=json.dumps(body), headers=headers)
+            response = connection.getresponse()
+            return response.status, len(response.read())
+        finally:
+            connection.close()
+
+
+class WSGITarget(HTTPTarget):
+    """Sends HTTP requests to the app served by a threaded WSGI server on a local port."""
+
+    name = 'wsgi'
+
+    def __init__(self):
+        self.server = make_server('127.0.0.1', 0, service.app, threaded=True, request_handler=QuietRequestHandler)
+        self.port = self.server.server_port
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.thread.join()
+
+
+class UvicornTarget(HTTPTarget):
+    """Sends HTTP requests to the ASGI app served by uvicorn on a local port."""
+
+    name = 'uvicorn'
+
+    def __init__(self):
+        self.socket = socket.socket()
+        self.socket.bind(('127.0.0.1', 0))
+        self.port = self.socket.getsockname()[1]
+        self.server = uvicorn.Server(uvicorn.Config(asgi.app, log_level='warning', lifespan='on'))
+        self.thread = threading.Thread(target=self.server.run, kwargs={'sockets': [self.socket]}, daemon=True)
+        self.thread.start()
+        while not self.server.started:
+            time.sleep(0.01)
+
+    def close(self):
+        self.server.should_exit = True
+        self.thread.join()
+        self.socket.close()
+
+
+targets = {
+    'test_client': TestClientTarget,
+    'wsgi': WSGITarget,
+    'asgi': ASGITarget,
+}
+if uvicorn is not None:
+    targets['uvicorn'] = UvicornTarget
+
+
+def run_route(target, path, headers, body, requests, concurrency):
+    """Send requests to one route. Return a dict of latency percentiles (ms), throughput and body size."""
+
+    def timed_get(_):
+        start = time.perf_counter()
+        status, size = target.send(path, headers, body)
+        latency = time.perf_counter() - start
+        if status != 200:
+            raise RuntimeError('{0} returned {1}'.format(path, status))
+        return latency, size
+
+    target.send(path, headers, body)  # Warm up.
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        results = list(pool.map(timed_get, range(requests)))
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(latency for latency, _ in results)
+    return {
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p90_ms': percentile(latencies, 90) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'max_ms': latencies[-1] * 1000,
+        'requests_per_s': requests / elapsed,
+        'bytes': results[0][1],
+    }
+
+
+def percentile(sorted_values, pct):
+    """Return the nearest-rank percentile of a sorted list."""
+
+    rank = max(int(round(pct / 100.0 * len(sorted_values))) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+def measure_reloads(user_file, group_file):
+    """Return full and one-line-append reload times (s) for both files."""
+
+    results = {}
+    for kind, path, line in [('users', user_file, 'extra:x:1:1:Extra::/bin/sh\n'),
+                             ('groups', group_file, 'extra:x:1:\n')]:
+        refresh = service.refresh_users if kind == 'users' else service.refresh_groups
+
+        # Full reload from an empty snapshot.
+        if kind == 'users':
+            service.user_snapshot = service.Snapshot()
+        else:
+            service.group_snapshot = service.Snapshot()
+        start = time.perf_counter()
+        refresh()
+        results[kind + '_full_s'] = time.perf_counter() - start
+
+        # Reload after appending a line.
+        with open(path, 'a') as file:
+            file.write(line)
+        os.utime(path, (time.time() + 1, time.time() + 1))
+        start = time.perf_counter()
+        refresh()
+        results[kind + '_append_s'] = time.perf_counter() - start
+
+    return results
+
+
+def measure_formats():
+    """
+    Return the size (bytes), serialization time from the snapshot (s, uncached) and client decode time (s)
+    of the full user listing in each wire format, against building it with a single dumps() call.
+    """
+
+    snapshot = service.user_snapshot
+    formats = [
+        ('json_dumps', lambda: json.dumps([row.to_json() for row in snapshot.rows]).encode(), json.loads),
+        ('json', lambda: service.join_json(snapshot.body(i) for i in range(len(snapshot.rows))), json.loads),
+        ('columns', lambda: service.format_body(snapshot, None, 'columns', service.user_cols), json.loads),
+    ]
+    if service.msgpack is not None:
+        formats.append(('msgpack', lambda: service.format_body(snapshot, None, 'msgpack'),
+                        service.msgpack.unpackb))
+
+    results = {}
+    for name, encode, decode in formats:
+        snapshot.format_bodies.clear()
+        start = time.perf_counter()
+        body = encode()
+        encode_s = time.perf_counter() - start
+        start = time.perf_counter()
+        decode(body)
+        results[name] = {'bytes': len(body), 'encode_s': encode_s, 'decode_s': time.perf_counter() - start}
+    snapshot.format_bodies.clear()
+
+    return results
+
+
+def peak_rss_mb():
+    """Return the peak resident set size of this process in MB."""
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak / 1e6  # Bytes on macOS.
+    return peak / 1e3  # Kilobytes on Linux.
+
+
+def run(users, groups, members, requests, concurrency, target_names, seed=0, out=sys.stdout):
+    """Run the whole benchmark. Return the results as a dict."""
+
+    results = {
+        'config': {'users': users, 'groups': groups, 'members': members,
+                   'requests': requests, 'concurrency': concurrency},
+        'reload': {},
+        'formats': {},
+        'routes': {},
+    }
+    old_paths = service.user_path, service.group_path
+    with tempfile.TemporaryDirectory() as directory:
+        user_file, group_file = generate_files(directory, users, groups, members, seed)
+        service.user_path, service.group_path = user_file, group_file
+        service.add_source(source_name, user_file, group_file)
+        try:
+            results['reload'] = measure_reloads(user_file, group_file)
+            results['peak_rss_mb_after_load'] = peak_rss_mb()
+            print_reload(results['reload'], out)
+            results['formats'] = measure_formats()
+            print_formats(results['formats'], out)
+
+            for target_name in target_names:
+                target = targets[target_name]()
+                try:
+                    versions = service.user_changes.version, service.group_changes.version
+                    for name, path, headers, body in get_routes(users, groups, versions):
+                        route_result = run_route(target, path, headers, body, requests, concurrency)
+                        results['routes'][target_name + ':' + name] = route_result
+                        print_route(target_name, name, route_result, out)
+                finally:
+                    target.close()
+        finally:
+            service.user_path, service.group_path = old_paths
+            service.remove_source(source_name)
+            service.user_snapshot = service.Snapshot()
+            service.group_snapshot = service.Snapshot()
+
+    results['peak_rss_mb'] = peak_rss_mb()
+    print('peak RSS: {0:.1f} MB'.format(results['peak_rss_mb']), file=out)
+
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Return a list of routes whose p50 latency is worse than baseline by more than tolerance (a fraction)."""
+
+    regressions = []
+    for key, route_result in results['routes'].items():
+        base = baseline.get('routes', {}).get(key)
+        if base is not None and route_result['p50_ms'] > base['p50_ms'] * (1 + tolerance):
+            regressions.append('{0}: p50 {1:.3f} ms vs baseline {2:.3f} ms'.format(
+                key, route_result['p50_ms'], base['p50_ms']))
+
+    return regressions
+
+
+def print_reload(reload_results, out):
+    """Print reload times."""
+
+    for key, value in reload_results.items():
+        print('reload {0}: {1:.3f} s'.format(key, value), file=out)
+
+
+def print_formats(format_results, out):
+    """Print wire format sizes and times."""
+
+    for name, result in format_results.items():
+        print('format {0:10} {bytes:10d} B  encode {1:8.3f} ms  decode {2:8.3f} ms'.format(
+            name, result['encode_s'] * 1000, result['decode_s'] * 1000, **result), file=out)
+
+
+def print_route(target_name, name, route_result, out):
+    """Print one route's results."""
+
+    print('{0:12} {1:24} p50 {p50_ms:8.3f} ms  p90 {p90_ms:8.3f} ms  p99 {p99_ms:8.3f} ms  '
+          '{requests_per_s:9.1f} req/s  {bytes:10d} B'.format(target_name, name, **route_result), file=out)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--users', type=int, default=10000, help='number of users to generate')
+    parser.add_argument('--groups', type=int, default=1000, help='number of groups to generate')
+    parser.add_argument('--members', type=int, default=1000, help='maximum members per group')
+    parser.add_argument('--requests', type=int, default=200, help='requests per route')
+    parser.add_argument('--concurrency', type=int, default=1, help='concurrent requests per route')
+    parser.add_argument('--target', choices=sorted(targets), action='append',
+                        help='how to send requests (default: all)')
+    parser.add_argument('--seed', type=int, default=0, help='random seed for file generation')
+    parser.add_argument('--save', help='write results to this JSON file')
+    parser.add_argument('--baseline', help='compare p50 latencies against this saved JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed p50 slowdown against the baseline, as a fraction')
+    args = parser.parse_args(argv)
+
+    results = run(args.users, args.groups, args.members, args.requests, args.concurrency,
+                  args.target or sorted(targets), args.seed)
+
+    if args.save:
+        with open(args.save, 'w') as file:
+            json.dump(results, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        if regressions:
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,207 @@
+"""
+This script serves the PasswordAsAService web API from several pre-forked worker processes.
+
+A single loader process reads the passwd and group files like the file watcher does, and writes each
+new version as a binary snapshot file (see service.write_snapshot_file()) to a shared directory,
+replacing the previous file atomically. Workers never parse the files: they map the snapshot files
+read-only, so the data is held once in the page cache however many workers there are, and switch
+to each new version with a single assignment. All workers accept connections on one shared socket.
+"""
+
+import argparse
+import os
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import time
+import traceback
+
+from werkzeug.serving import make_server
+
+import service
+
+
+snapshot_names = {'users': 'users.snapshot', 'groups': 'groups.snapshot'}
+startup_timeout = 30.0  # Seconds a worker waits for the loader's first snapshot files.
+
+
+class SnapshotWriter(service.FileWatcher):
+    """Loader: re-reads the user and group files when they change, writing each new version to a directory."""
+
+    def __init__(self, directory, poll_interval):
+        super().__init__(poll_interval)
+        self.directory = directory
+
+    def refresh(self):
+        """Re-read the user and group files if they changed, and write out any new snapshots."""
+
+        if service.refresh_users():
+            write_snapshot(self.directory, 'users', service.user_snapshot)
+        if service.refresh_groups():
+            write_snapshot(self.directory, 'groups', service.group_snapshot)
+
+
+class SnapshotFollower(service.FileWatcher):
+    """Worker: maps each new snapshot file the loader writes and publishes it to the service."""
+
+    def __init__(self, directory, poll_interval):
+        super().__init__(poll_interval, dirs=[directory])
+        self.directory = directory
+        self.file_ids = {}  # Maps 'users'/'groups' to (inode, modify time, size) of the file mapped.
+
+    def refresh(self):
+        """Map any snapshot files that are new since the last check."""
+
+        for kind, name in snapshot_names.items():
+            file_name = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(file_name)
+            except FileNotFoundError:
+                continue
+            file_id = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+            if self.file_ids.get(kind) != file_id:
+                publish_snapshot(kind, service.map_snapshot_file(file_name))
+                self.file_ids[kind] = file_id
+
+    def loaded(self):
+        """Return True once both snapshot files have been mapped."""
+
+        return len(self.file_ids) == len(snapshot_names)
+
+
+def write_snapshot(directory, kind, snapshot):
+    """Write a user or group snapshot to its file in directory."""
+
+    service.write_snapshot_file(snapshot, os.path.join(directory, snapshot_names[kind]), kind)
+
+
+def publish_snapshot(kind, snapshot):
+    """Make a mapped snapshot the current user or group snapshot, logging its changes."""
+
+    if kind == 'users':
+        if not snapshot.error:
+            service.user_changes.record(snapshot)
+        service.user_snapshot = snapshot
+    else:
+        if not snapshot.error:
+            service.group_changes.record(snapshot)
+        service.group_snapshot = snapshot
+    service.query_cache.invalidate(kind, snapshot.version)
+
+
+def run_loader(directory, poll_interval):
+    """Loader process: write both snapshot files, then rewrite them whenever the source files change."""
+
+    writer = SnapshotWriter(directory, poll_interval)
+    writer.refresh()
+    writer.run()
+
+
+def run_worker(listen_socket, directory, poll_interval):
+    """Worker process: wait for the loader's snapshot files, then serve requests from them."""
+
+    follower = SnapshotFollower(directory, poll_interval)
+    deadline = time.monotonic() + startup_timeout
+    follower.refresh()
+    while not follower.loaded():
+        if time.monotonic() > deadline:
+            raise RuntimeError('no snapshot files in {0}'.format(directory))
+        time.sleep(0.05)
+        follower.refresh()
+
+    # Set the follower as the file watcher, so requests never read the source files themselves.
+    service.file_watcher = follower
+    follower.start()
+
+    server = make_server(*listen_socket.getsockname()[:2], service.app, threaded=True, fd=listen_socket.fileno())
+    server.serve_forever()
+
+
+def fork(target, *args):
+    """Run target(*args) in a child process that exits when it returns. Return the child's pid."""
+
+    pid = os.fork()
+    if pid == 0:
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        try:
+            target(*args)
+        except BaseException:
+            traceback.print_exc()
+            os._exit(1)
+        os._exit(0)
+
+    return pid
+
+
+def serve(host, port, workers, directory, poll_interval):
+    """
+    Start the loader and worker processes, and restart any that exit, until SIGTERM or SIGINT.
+    The processes are forked before anything is loaded, so workers don't inherit parsed data.
+    """
+
+    listen_socket = socket.create_server((host, port), backlog=128)
+    print('serving on http://{0}:{1} with {2} workers'.format(*listen_socket.getsockname()[:2], workers), flush=True)
+
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, stop)
+    children = {}  # Maps pid to (target, args), to restart it.
+    try:
+        for target, args in [(run_loader, (directory, poll_interval))] + \
+                [(run_worker, (listen_socket, directory, poll_interval))] * workers:
+            children[fork(target, *args)] = (target, args)
+        while True:
+            pid, _ = os.wait()
+            target, args = children.pop(pid)
+            time.sleep(1)  # Don't spin if a process keeps failing.
+            children[fork(target, *args)] = (target, args)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in children:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+        listen_socket.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on')
+    parser.add_argument('--port', type=int, default=5000, help='port to listen on')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='number of worker processes')
+    parser.add_argument('--passwd', help='passwd file (default: {0})'.format(service.user_path_default))
+    parser.add_argument('--group', help='group file (default: {0})'.format(service.group_path_default))
+    parser.add_argument('--snapshot-dir', help='directory for the shared snapshot files (default: a temporary one)')
+    parser.add_argument('--cache-dir', help='directory to cache parsed files in, for faster restarts')
+    parser.add_argument('--poll-interval', type=float, default=service.watch_poll_interval,
+                        help='seconds between file checks')
+    args = parser.parse_args(argv)
+
+    service.user_path = args.passwd
+    service.group_path = args.group
+    service.index_cache_dir = args.cache_dir
+    directory = args.snapshot_dir or tempfile.mkdtemp(prefix='paas-')
+    try:
+        serve(args.host, args.port, args.workers, directory, args.poll_interval)
+    finally:
+        if args.snapshot_dir is None:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
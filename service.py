@@ -4,27 +4,167 @@ It uses Flask and returns the data in JSON format.
 """
 
 
-from flask import Flask, request, abort
-from json import dumps
-import csv
+from flask import Flask, Response, request, abort, make_response, g
+from werkzeug.http import parse_accept_header
+from json import dumps, loads
+from itertools import islice
+from functools import partial
+from collections import OrderedDict, deque
+from datetime import datetime, timezone
+import hashlib
+import hmac
+import random
+from bisect import bisect_left, bisect_right
+import operator
+import re
+from array import array
+import base64
+import binascii
 import os
-import copy
+import mmap
+import sys
+import time
+import select
+import threading
+import ctypes
+import ctypes.util
+import gzip
+
+try:
+    import brotli
+except ImportError:
+    brotli = None  # Responses are only gzip-compressed without it.
+
+try:
+    import re2
+except ImportError:
+    re2 = None  # Regex queries are limited to patterns that can't backtrack badly without it, see compile_regex().
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None  # MessagePack responses are not offered without it.
 
 
 # Set global user variables.
-last_user_time = None
-user_list = []
 user_path = None  # os.path.join(os.getcwd(), 'etc', 'passwd')  # Change to supply non-default passwd file path.
 user_path_default = os.path.join(os.sep, 'etc', 'passwd')
 user_cols = ['name', 'uid', 'gid', 'comment', 'home', 'shell']
+user_int_cols = ['uid', 'gid']  # Stored as int when the file has an integer.
+user_index_cols = ['name', 'uid', 'gid', 'shell']
+user_reload_lock = threading.Lock()
 
 # Set global group variables.
-last_group_time = None
-group_list = []
 group_path = None  # os.path.join(os.getcwd(), 'etc', 'group')  # Change to supply non-default group file path.
 group_path_default = os.path.join(os.sep, 'etc', 'group')
 group_cols = ['name', 'gid', 'member']
 group_cols_output = ['name', 'gid', 'members']
+group_int_cols = ['gid']  # Stored as int when the file has an integer.
+group_index_cols = ['name', 'gid']
+group_reload_lock = threading.Lock()
+
+# Set global source variables.
+sources_dir = None  # Directory of per-host directories each holding passwd and group files, see scan_sources().
+source_prefix = '/sources/<source>'  # Each source's copy of the data routes is under this.
+unsourced_rules = ['/metrics', '/sources', '/users/<int:uid>/sources', '/profiles',
+                   '/profiles/<int:profile_id>']  # Routes not copied for each source.
+sources = {}  # Maps name to Source, see add_source().
+sources_lock = threading.Lock()
+uid_sources = {}  # Maps uid to set of names of the sources that may have it, see index_source_uids().
+row_pools = {'users': {}, 'groups': {}}  # Rows shared by all sources, see read_rows().
+
+# Set global streaming variables.
+ndjson_mimetype = 'application/x-ndjson'
+stream_chunk_rows = 1000  # Rows joined per chunk of a streamed response.
+
+# Set global wire format variables.
+msgpack_mimetype = 'application/msgpack'
+columns_mimetype = 'application/vnd.paas.columns+json'  # {"column": [values]} instead of a list of objects.
+list_rules = ['/users', '/users/query', '/users/<int:uid>/groups', '/groups', '/groups/query']  # Return rows.
+msgpack_rules = list_rules + ['/users/<int:uid>', '/users/batch', '/users/changes',
+                              '/groups/<int:gid>', '/groups/batch', '/groups/changes']
+
+# Set global expansion variables.
+expand_rules = ['/users', '/users/query', '/users/<int:uid>']  # Take expand=groups, inlining each user's groups.
+
+# Set global query variables.
+range_ops = {'gt': operator.gt, 'gte': operator.ge, 'lt': operator.lt, 'lte': operator.le}  # For int columns.
+regex_max_length = 200  # Longest regex accepted in a col_regex arg.
+regex_max_repeats = 1  # Most *, +, ? and {m,n} quantifiers in a regex when re2 is not installed.
+regex_quantifier = re.compile(r'([*+?]|\{\d*,\d*\})|\{\d+\}')  # Group 1 matches variable counts.
+
+# Set global query result cache variables.
+query_cache_entries = 1000  # Most query results kept; 0 turns the cache off.
+query_cache_bytes = 64 * 2 ** 20  # Most bytes of result bodies kept.
+query_cache_entry_bytes = 4 * 2 ** 20  # Larger results are not kept.
+
+# Set global pagination variables.
+page_args = ['limit', 'offset', 'cursor']
+
+# Set global HTTP caching variables.
+cache_control = 'public, no-cache'  # Caches may store responses but must revalidate them with the ETag.
+uncached_rules = ['/metrics', '/users/changes', '/groups/changes', '/sources', '/users/<int:uid>/sources',
+                  '/profiles', '/profiles/<int:profile_id>']  # GET routes without ETags.
+
+# Set global compression variables.
+compressed_rules = ['/users', '/users/<int:uid>', '/groups', '/groups/<int:gid>']  # Served from cached bodies.
+content_encodings = (['br'] if brotli is not None else []) + ['gzip']  # In order of preference.
+compress_min_size = 1024  # Smaller bodies are sent uncompressed.
+gzip_level = 9
+brotli_quality = 9  # 10 and 11 are several times slower on large listings for little gain.
+
+# Set global admission control variables.
+route_costs = {'/users': 4, '/groups': 4, '/users/query': 2, '/groups/query': 2,
+               '/users/batch': 2, '/groups/batch': 2}  # Capacity used while building a response; others never wait.
+admission_capacity = 4 * (os.cpu_count() or 1)  # Cost units in use at once; 0 turns admission control off.
+admission_queue_length = 64  # Most requests waiting for capacity; more are shed at once.
+admission_timeout = 2.0  # Longest wait in seconds for capacity before a request is shed.
+shed_retry_after = 1  # Seconds in the Retry-After header of shed requests.
+
+# Set global change feed variables.
+change_history = 100  # Most file versions kept in each change log.
+changes_max_wait = 30.0  # Longest wait in seconds accepted for a long-polled change request.
+
+# Set global batch variables.
+batch_limit = 10000  # Most ids/names accepted in one batch request.
+
+# Set global snapshot file variables.
+snapshot_file_magic = b'PAASSNAP'
+snapshot_file_format = 1  # Bump when the layout changes; files of other formats are rejected.
+index_cache_dir = None  # Directory to cache parsed files in as snapshot files, see load_cached_snapshot().
+
+# Set global file watcher variables.
+watch_files = True  # Start the file watcher when run as a script.
+watch_poll_interval = 1.0  # Seconds between file checks, with or without inotify.
+file_watcher = None
+inotify_mask = 0x8 | 0x40 | 0x80 | 0x200 | 0x4  # IN_CLOSE_WRITE, IN_MOVED_FROM/TO, IN_DELETE, IN_ATTRIB.
+inotify_settle_time = 0.05
+
+# Set global metrics variables.
+metrics_mimetype = 'text/plain; version=0.0.4'
+metrics_lock = threading.Lock()
+time_stages = False  # Record per-stage timings in /metrics; no cost when False.
+latency_buckets = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+request_counts = {}  # Maps (route, method, status) to count.
+request_latency = {}  # Maps route to Histogram.
+file_checks = {}  # Maps (file, 'unchanged' or 'changed') to count of modify time checks.
+reload_latency = {}  # Maps file to Histogram of reload durations.
+reload_failures = {}  # Maps file to count of failed reloads.
+stage_latency = {}  # Maps stage name to Histogram, if time_stages is True.
+query_cache_lookups = {}  # Maps (file, 'hit' or 'miss') to count of query result cache lookups.
+query_cache_evictions = {}  # Maps file to count of query results evicted to make room.
+admission_waits = {}  # Maps route to Histogram of time waited for admission.
+admission_shed = {}  # Maps route to count of requests shed with 503.
+
+# Set global profiling variables.
+profile_token = None  # Admin token; profiling and /profiles are off until set, see start_profile().
+profile_sample_rate = 0.0  # Fraction of all requests profiled without an X-Profile header.
+profile_interval = 0.005  # Seconds between stack samples; shorter is limited by sys.getswitchinterval().
+profile_history = 50  # Most profiles kept.
+profile_functions = ['read_users', 'read_groups', 'find_rows', 'convert_to_int', 'dumps']  # Totalled per profile.
+profiles = deque(maxlen=profile_history)  # Finished profiles, oldest first.
+profile_ids = iter(range(1, sys.maxsize))
+profiles_lock = threading.Lock()  # Held to add a profile or copy the list, as requests run in threads.
 
 # Initiate the service.
 app = Flask(__name__)
@@ -34,306 +174,2744 @@ app = Flask(__name__)
 def get_users_all():
     """Return a list of all users."""
 
-    # Get all users, convert to JSON.
-    all_users = []
-    for user in read_users():
-        temp_json = {}
-        for j in range(len(user_cols)):
-            temp_json[user_cols[j]] = convert_to_int(user[j])
-        all_users.append(temp_json)
-
-    return dumps(all_users)
+    # Serve the cached JSON listing.
+    users = read_users()
+    if not wants_stream() and not wants_page() and expand_groups() is None:
+        return cached_response(users, cols=user_cols)
+    return list_response(users, lambda start: range(start, len(users.rows)), user_cols)
 
 
 @app.route('/users/query', methods=['GET'])
 def get_users_query():
-    """Return list of users matching search criteria (exact match)."""
-
-    # These items will default to None if not present in querystring.
-    name = request.args.get('name')
-    uid = request.args.get('uid')
-    gid = request.args.get('gid')
-    comment = request.args.get('comment')
-    home = request.args.get('home')
-    shell = request.args.get('shell')
-    in_args = [name, uid, gid, comment, home, shell]
-
-    # Get users that match criteria.
-    sorted_users = copy.deepcopy(read_users())
-    remove_list = []
-    for i, user in enumerate(sorted_users):
-
-        # Check all search criteria for each user.
-        remove_user = False
-        for j in range(len(user_cols)):
-            if in_args[j] is not None and in_args[j] != user[j]:
-                remove_user = True
-                break
-
-        # If no match, add to list for removal.
-        if remove_user:
-            remove_list.append(i)
-
-        # If match, convert to JSON.
-        else:
-            temp_json = {}
-            for j in range(len(user_cols)):
-                temp_json[user_cols[j]] = convert_to_int(user[j])
-            sorted_users[i] = temp_json
+    """Return list of users matching search criteria, see get_conditions()."""
 
-    # Remove users with no match.
-    for index in sorted(remove_list, reverse=True):
-        del sorted_users[index]
+    # Collect the conditions from the querystring args that were supplied.
+    conditions = get_conditions(user_cols, user_int_cols)
 
-    return dumps(sorted_users)
+    # Filter users lazily, page and join cached JSON of matches, unless the result is cached.
+    users = read_users()
+    return cached_query(users, 'users', conditions,
+                        lambda: list_response(users, lambda start: find_rows(users, conditions, start), user_cols))
 
 
 @app.route('/users/<int:uid>', methods=['GET'])
 def get_user_single(uid):
     """Return single user matching uid."""
 
-    # Filter to single user.
-    found_user = None
-    for user in read_users():
-        if user[user_cols.index('uid')] == str(uid):
-            found_user = user
-            break
-    if found_user is None:
+    # Look up single user by uid, serve the cached JSON.
+    users = read_users()
+    found_users = lookup(users.index['uid'], uid)
+    if not found_users:
         abort(404)
 
-    # Convert user to JSON.
-    return_json = {}
-    for i in range(len(user_cols)):
-        return_json[user_cols[i]] = convert_to_int(found_user[i])
-
-    return dumps(return_json)
+    expand = expand_groups()
+    if expand is not None:
+        return expanded_user_body(users, *expand, found_users[0])
+    return cached_response(users, found_users[0])
 
 
 @app.route('/users/<int:uid>/groups', methods=['GET'])
 def get_user_groups(uid):
-    """Return all groups that user is a member of."""
+    """Return all groups that user is a member of, and with primary_group=1 the group of the user's gid."""
 
-    # Get user name from uid.
-    name = None
-    for user in read_users():
-        if user[user_cols.index('uid')] == str(uid):
-            name = user[user_cols.index('name')]
-            break
-    if name is None:
+    # Get user from uid.
+    users = read_users()
+    found_users = lookup(users.index['uid'], uid)
+    if not found_users:
         abort(404)
+    user = users.rows[found_users[0]]
+
+    # Look up list of groups, join their cached bodies.
+    groups = read_groups()
+    return rows_response(groups, user_group_positions(groups, wants_primary_group(), user), group_cols_output)
+
+
+@app.route('/users/<int:uid>/sources', methods=['GET'])
+def get_user_sources(uid):
+    """Return the user with uid in each source that has one, as {source name: user}."""
+
+    # Unless the file watcher does, find new sources and load changed files, so the uid index is current.
+    if not watcher_running():
+        refresh_sources()
+
+    # Narrow down the sources with the uid index, then look the uid up in each.
+    with sources_lock:
+        names = sorted(uid_sources.get(uid, ()))
+    parts = []
+    for name in names:
+        source = sources.get(name)
+        if source is None:
+            continue
+        users = source.snapshots['users']
+        found_users = lookup(users.index.get('uid', {}), uid)
+        if found_users and not users.error:
+            parts.append((name, users.body(found_users[0])))
+
+    return join_json_object(parts)
+
+
+@app.route('/users/batch', methods=['POST'])
+def get_users_batch():
+    """Return users for lists of uids and/or names, as {"uids": {uid: user}, "names": {name: user}}."""
+
+    # Get the lists of keys from the JSON body.
+    batch = get_batch_args({'uids': 'uid', 'names': 'name'})
+
+    # Look up each key, null if not found.
+    users = read_users()
+    parts = []
+    for arg, keys in batch.items():
+        col = 'uid' if arg == 'uids' else 'name'
+        parts.append((arg, join_json_object((key, first_body(users, col, key)) for key in keys)))
+
+    return join_json_object(parts)
 
-    # Filter to list of groups.
-    return_groups = []
-    for group in read_groups():
-        if name in group[group_cols.index('member')]:
-            temp_json = {}
-            for j in range(len(group_cols_output)):
-                temp_json[group_cols_output[j]] = convert_to_int(group[j])
-            return_groups.append(temp_json)
 
-    return dumps(return_groups)
+@app.route('/users/changes', methods=['GET'])
+def get_users_changes():
+    """Return users added, modified and removed since the user file version in the since arg."""
+
+    # Check the file, then merge the logged changes.
+    read_users()
+    return changes_response(*change_log('users'))
 
 
 @app.route('/groups', methods=['GET'])
 def get_groups_all():
     """Return list of all groups."""
 
-    # Get all groups, convert to JSON.
-    all_groups = []
-    for group in read_groups():
-        temp_json = {}
-        for j in range(len(group_cols_output)):
-            temp_json[group_cols_output[j]] = convert_to_int(group[j])
-        all_groups.append(temp_json)
-
-    return dumps(all_groups)
+    # Serve the cached JSON listing.
+    groups = read_groups()
+    if not wants_stream() and not wants_page():
+        return cached_response(groups, cols=group_cols_output)
+    return list_response(groups, lambda start: range(start, len(groups.rows)), group_cols_output)
 
 
 @app.route('/groups/query', methods=['GET'])
 def get_groups_query():
-    """Return list of groups matching search criteria (exact match)."""
-
-    # These items will default to None if not present in querystring.
-    name = request.args.get('name')
-    gid = request.args.get('gid')
-    member = request.args.getlist('member')
-    if len(member) == 0 or member is None:
-        member = []
-    in_args = [name, gid, member]
-
-    # Get groups that match criteria.
-    sorted_groups = copy.deepcopy(read_groups())
-    remove_list = []
-    for i, group in enumerate(sorted_groups):
-
-        # Check all search criteria for each group.
-        remove_group = False
-        for j in range(len(group_cols)):
-
-            # For name and gid.
-            if j != 2:
-                if in_args[j] is not None and in_args[j] != group[j]:
-                    remove_group = True
-                    break
-
-            # Check all members; if any are missing, remove.
-            elif j == 2:
-                for member in in_args[2]:
-                    if member not in group[2]:
-                        remove_group = True
-                        break
-
-        # If no match, add to list for removal.
-        if remove_group:
-            remove_list.append(i)
-
-        # If match, convert to JSON.
+    """Return list of groups matching search criteria, see get_conditions()."""
+
+    # Collect the conditions from the querystring args that were supplied.
+    conditions = get_conditions(['name', 'gid'], group_int_cols, members=True)
+
+    # Filter groups lazily, page and join cached JSON of matches, unless the result is cached.
+    groups = read_groups()
+    return cached_query(groups, 'groups', conditions,
+                        lambda: list_response(groups, lambda start: find_rows(groups, conditions, start),
+                                              group_cols_output))
+
+
+@app.route('/groups/batch', methods=['POST'])
+def get_groups_batch():
+    """
+    Return groups for lists of gids and/or names, and group lists for lists of user uids and/or members.
+    Output is {"gids": {gid: group}, "names": {name: group}, "uids": {uid: [groups]}, "members": {name: [groups]}}.
+    """
+
+    # Get the lists of keys from the JSON body.
+    batch = get_batch_args({'gids': 'gid', 'names': 'name', 'uids': 'uid', 'members': 'name'})
+
+    # Look up each key, null if not found.
+    groups = read_groups()
+    users = read_users() if 'uids' in batch else None
+    parts = []
+    for arg, keys in batch.items():
+        if arg in ['gids', 'names']:
+            col = 'gid' if arg == 'gids' else 'name'
+            bodies = ((key, first_body(groups, col, key)) for key in keys)
+        elif arg == 'uids':
+            bodies = ((key, member_groups_body(groups, users, key)) for key in keys)
         else:
-            temp_json = {}
-            for j in range(len(group_cols_output)):
-                temp_json[group_cols_output[j]] = convert_to_int(group[j])
-            sorted_groups[i] = temp_json
+            bodies = ((key, join_json(groups.body(i) for i in lookup(groups.member_index, key))) for key in keys)
+        parts.append((arg, join_json_object(bodies)))
+
+    return join_json_object(parts)
 
-    # Remove groups with no match.
-    for index in sorted(remove_list, reverse=True):
-        del sorted_groups[index]
 
-    return dumps(sorted_groups)
+@app.route('/groups/changes', methods=['GET'])
+def get_groups_changes():
+    """Return groups added, modified and removed since the group file version in the since arg."""
+
+    # Check the file, then merge the logged changes.
+    read_groups()
+    return changes_response(*change_log('groups'))
 
 
 @app.route('/groups/<int:gid>', methods=['GET'])
 def get_group_single(gid):
     """Return single group matching gid."""
 
-    # Filter to single group.
-    found_group = None
-    for group in read_groups():
-        if group[group_cols.index('gid')] == str(gid):
-            found_group = group
-            break
+    # Look up single group by gid, serve the cached JSON.
+    groups = read_groups()
+    found_groups = lookup(groups.index['gid'], gid)
+    if not found_groups:
+        abort(404)
+
+    return cached_response(groups, found_groups[0])
+
+
+@app.route('/sources', methods=['GET'])
+def get_sources():
+    """Return the names of all sources."""
 
-    if found_group is None:
+    if not watcher_running():
+        scan_sources()
+    return dumps(sorted(sources)).encode()
+
+
+@app.route('/profiles', methods=['GET'])
+def get_profiles():
+    """Return summaries of the kept request profiles, newest first. Needs the admin token in X-Profile."""
+
+    check_profile_token()
+    with profiles_lock:
+        kept = list(profiles)
+    return dumps([profile_summary(profile) for profile in reversed(kept)]).encode()
+
+
+@app.route('/profiles/<int:profile_id>', methods=['GET'])
+def get_profile(profile_id):
+    """
+    Return a request profile as collapsed stacks, one "frame;frame;... count" line per stack, ready for
+    flamegraph.pl or speedscope. Needs the admin token in X-Profile.
+    """
+
+    check_profile_token()
+    with profiles_lock:
+        kept = list(profiles)
+    profile = next((profile for profile in kept if profile['id'] == profile_id), None)
+    if profile is None:
         abort(404)
+    lines = ['{0} {1}\n'.format(';'.join(stack), count) for stack, count in sorted(profile['stacks'].items())]
+    response = Response(''.join(lines), mimetype='text/plain')
+    response.headers['Content-Disposition'] = 'attachment; filename=profile-{0}.folded'.format(profile_id)
+    return response
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Return service metrics in Prometheus text format."""
+
+    return Response(format_metrics(), mimetype=metrics_mimetype)
+
+
+@app.url_value_preprocessor
+def pull_source(endpoint, values):
+    """Take the source name out of the args of a /sources/<source>/... route, making it the request's source."""
+
+    if values and 'source' in values:
+        g.source = get_source(values.pop('source'))
+
+
+@app.before_request
+def start_request_timer():
+    """Note when the request started, for the latency metrics."""
+
+    g.request_start = time.perf_counter()
+
+
+@app.before_request
+def start_profile():
+    """
+    Start sampling the request's stack if it has an X-Profile header with the admin token,
+    or if picked at profile_sample_rate. Nothing else is done while profiling is off.
+    """
+
+    if profile_token is None or request.path.startswith('/profiles'):
+        return
+    header = request.headers.get('X-Profile')
+    if header is not None:
+        if not hmac.compare_digest(header.encode(), profile_token.encode()):
+            abort(403)
+    elif not profile_sample_rate or random.random() >= profile_sample_rate:
+        return
+    g.profiler = ProfileSampler(threading.get_ident(), profile_interval)
+    g.profiler.start()
+
+
+@app.before_request
+def check_conditional():
+    """
+    Work out the ETag and Last-Modified time of a GET response from the file versions it depends on.
+    Answer with 304 Not Modified, without building the response, if the client's copy is current
+    and the response would have been 200, see check_request().
+    """
+
+    snapshots = request_snapshots()
+    if snapshots is None:
+        return None
+    if route_rule() in compressed_rules and not wants_stream() and not wants_page() and expand_groups() is None:
+        g.content_encoding = choose_encoding(request.headers.get('Accept-Encoding', ''))
+    g.etag = make_etag(snapshots)
+    g.last_modified = last_modified(snapshots)
+
+    # If-None-Match takes precedence over If-Modified-Since.
+    if request.if_none_match:
+        not_modified = request.if_none_match.contains(g.etag)
+    else:
+        not_modified = request.if_modified_since is not None and g.last_modified <= request.if_modified_since
+    if not_modified:
+        check_request(route_rule())
+        return Response(status=304)
+
+    return None
+
+
+def check_request(rule):
+    """
+    Abort as the view for a GET route rule would, before it runs: with 404 for a missing user or group,
+    400 for invalid query or page args, or 410 for a cursor made from another file version.
+    """
+
+    if rule in ['/users/<int:uid>', '/users/<int:uid>/groups']:
+        if not lookup(read_users().index['uid'], request.view_args['uid']):
+            abort(404)
+    elif rule == '/groups/<int:gid>':
+        if not lookup(read_groups().index['gid'], request.view_args['gid']):
+            abort(404)
+    elif rule == '/users/query':
+        get_conditions(user_cols, user_int_cols)
+    elif rule == '/groups/query':
+        get_conditions(['name', 'gid'], group_int_cols, members=True)
+
+    if rule in ['/users', '/users/query', '/groups', '/groups/query']:  # Paged, see list_response().
+        get_int_arg('limit', 1)
+        get_int_arg('offset', 0)
+        cursor_start((read_users() if rule in ['/users', '/users/query'] else read_groups()).file_time)
+
+
+@app.before_request
+def admit_request():
+    """
+    Hold a request to a route in route_costs until admission_limiter has room for its cost.
+    Answer with 503 and Retry-After if the queue is full or the wait passes admission_timeout.
+    Other routes and 304 responses are never held, so point lookups stay fast under load.
+    """
 
-    # Convert group to JSON.
-    return_json = {}
-    for i in range(len(group_cols_output)):
-        return_json[group_cols_output[i]] = convert_to_int(found_group[i])
-    return_json = dumps(return_json)
+    cost = route_costs.get(route_rule()) if admission_capacity > 0 else None
+    if not cost:
+        return None
+    start = time.perf_counter()
+    g.admitted_cost = admission_limiter.acquire(cost)
+    observe_metric(admission_waits, request.url_rule.rule, time.perf_counter() - start)
+    if not g.admitted_cost:
+        count_metric(admission_shed, request.url_rule.rule)
+        return Response(status=503, headers={'Retry-After': str(shed_retry_after)})
 
-    return return_json
+    return None
 
 
 @app.after_request
 def apply_headers(response):
-    """Tell receiving app that data is JSON via response header."""
+    """Tell receiving app that data is JSON via response header, add caching headers."""
+
+    if response.mimetype not in [ndjson_mimetype, msgpack_mimetype, columns_mimetype, 'text/plain']:
+        if response.status_code == 200 and wire_format() == 'msgpack':
+            pack_response(response)  # Routes without cached MessagePack bodies.
+        else:
+            response.headers['content-type'] = 'application/json'
+    if 'etag' in g and response.status_code in [200, 304]:
+        response.set_etag(g.etag)
+        response.last_modified = g.last_modified
+        response.headers['Cache-Control'] = cache_control
+        response.vary.add('Accept')
+        if 'content_encoding' in g:
+            response.vary.add('Accept-Encoding')
+
+        # Name the file versions the response came from, to continue from with the change feeds.
+        for header, snapshot in [('X-Users-Version', g.get('user_snapshot')),
+                                 ('X-Groups-Version', g.get('group_snapshot'))]:
+            if snapshot is not None:
+                response.headers[header] = str(snapshot.version)
+    if 'profiler' in g:
+        finish_profile(response)
+    record_request(response)
+    return response
+
+
+@app.teardown_request
+def stop_profile(exception):
+    """Stop the stack sampler of a request that ended without a response, e.g. on an uncaught exception."""
+
+    if 'profiler' in g:
+        g.profiler.stop()
+
+
+@app.after_request
+def hold_admission(response):
+    """
+    Keep the capacity of an admitted streamed response until the server has sent it and closed it,
+    as its rows are found and joined while it is sent.
+    """
+
+    if g.get('admitted_cost') and response.is_streamed:
+        response.call_on_close(partial(admission_limiter.release, g.pop('admitted_cost')))
+    return response
+
+
+@app.teardown_request
+def release_admission(exception):
+    """Give back the capacity an admitted request used, unless its streamed response still holds it."""
+
+    if g.get('admitted_cost'):
+        admission_limiter.release(g.pop('admitted_cost'))
+
+
+def request_snapshots():
+    """Return the user/group snapshots that a GET request's response depends on, or None if not cacheable."""
+
+    if request.method not in ['GET', 'HEAD'] or request.url_rule is None:
+        return None
+    rule = route_rule()
+    if rule in uncached_rules:
+        return None
+
+    snapshots = []
+    if rule.startswith('/users'):
+        snapshots.append(read_users())
+    if rule.startswith('/groups') or rule.endswith('/groups') or expand_groups() is not None:
+        snapshots.append(read_groups())
+
+    return snapshots
+
+
+def make_etag(snapshots):
+    """
+    Return a strong ETag (unquoted) for the request's file versions, path, querystring args, Accept header
+    and content encoding.
+    """
+
+    return etag_for(snapshots, request.path, request.args.items(multi=True), request.headers.get('Accept', ''),
+                    g.get('content_encoding', ''))
+
 
-    response.headers['content-type'] = 'application/json'
+def etag_for(snapshots, path, args, accept, encoding=''):
+    """
+    Return a strong ETag (unquoted) for file versions, a path, (arg, value) pairs, an Accept header
+    and a content encoding.
+    """
+
+    key = [repr(snapshot.file_time) for snapshot in snapshots]
+    key.append(path)
+    key.extend('{0}={1}'.format(arg, value) for arg, value in sorted(args))
+    key.append(accept)
+    if encoding:
+        key.append(encoding)
+
+    return hashlib.sha1('\n'.join(key).encode()).hexdigest()
+
+
+def last_modified(snapshots):
+    """Return the latest modify time of the snapshots' files as a UTC datetime, in whole seconds."""
+
+    return datetime.fromtimestamp(int(max(snapshot.file_time for snapshot in snapshots)), timezone.utc)
+
+
+def choose_encoding(accept_encoding):
+    """Return the content encoding the Accept-Encoding header value prefers, '' for none (identity)."""
+
+    accepted = parse_accept_header(accept_encoding)
+    best, best_quality = '', 0
+    for encoding in content_encodings:
+        quality = accepted[encoding]
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+
+    return best
+
+
+def encoded_body(snapshot, position, encoding, fmt='json', cols=None):
+    """
+    Return (body, encoding applied) for a snapshot's listing (position None) or the row at position,
+    in a wire format (see format_body()). Compressed bodies are made on first use and kept with the snapshot;
+    small ones are sent as they are.
+    """
+
+    body = format_body(snapshot, position, fmt, cols)
+    if not encoding or len(body) < compress_min_size:
+        return body, ''
+    key = (fmt, position, encoding)
+    compressed = snapshot.compressed.get(key)
+    if compressed is None:
+        stage_start = time.perf_counter()
+        if encoding == 'br':
+            compressed = brotli.compress(body, quality=brotli_quality)
+        else:
+            compressed = gzip.compress(body, compresslevel=gzip_level, mtime=0)
+        if time_stages:
+            record_stage('compress', stage_start)
+        snapshot.compressed[key] = compressed
+
+    return compressed, encoding
+
+
+def cached_response(snapshot, position=None, cols=None):
+    """
+    Return a response of a snapshot's cached listing (with its output columns) or row,
+    in the wire format and compressed as negotiated for the request.
+    """
+
+    fmt = wire_format()
+    body, encoding = encoded_body(snapshot, position, g.get('content_encoding', ''), fmt, cols)
+    if fmt == 'json' and not encoding:
+        return body
+    response = make_response(body)
+    if fmt != 'json':
+        response.mimetype = msgpack_mimetype if fmt == 'msgpack' else columns_mimetype
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
     return response
 
 
 def read_users():
+    """
+    Return the user snapshot for this request, from the request's source if it has one.
+    Unless the file watcher is running, check the user file for changes first.
+    """
+
+    users = g.get('user_snapshot')
+    if users is None and 'source' in g:
+        users = g.user_snapshot = read_source(g.source, 'users')
+    elif users is None:
+        if not watcher_running():
+            refresh_users(blocking=user_snapshot.file_time is None)
+        users = g.user_snapshot = user_snapshot  # Read the global once, so the request sees a single file version.
+    if users.error:
+        abort(500)
+
+    return users
+
+
+def read_groups():
+    """
+    Return the group snapshot for this request, from the request's source if it has one.
+    Unless the file watcher is running, check the group file for changes first.
+    """
+
+    groups = g.get('group_snapshot')
+    if groups is None and 'source' in g:
+        groups = g.group_snapshot = read_source(g.source, 'groups')
+    elif groups is None:
+        if not watcher_running():
+            refresh_groups(blocking=group_snapshot.file_time is None)
+        groups = g.group_snapshot = group_snapshot  # Read the global once, so the request sees a single file version.
+    if groups.error:
+        abort(500)
+
+    return groups
+
+
+def refresh_users(blocking=True):
     """
     Check last user file modify time.
-    If different than stored time, read the file.
-    Return user info.
+    If different than the current snapshot's, read the file and publish a new user snapshot.
+    If blocking is False and another thread is already reloading, return without waiting.
+    Return True if a new snapshot was published.
     """
 
-    global last_user_time
-    global user_list
+    global user_snapshot
 
-    # Check last file modification time.
-    file_name = None
-    file_mod_time = None
+    if not user_reload_lock.acquire(blocking):
+        return False
     try:
-        file_mod_time = os.path.getmtime(user_path)
-        file_name = user_path
-    except (OSError, TypeError):
-        # print('\n\tError accessing provided user file.')
-        # print('\tDefaulting to standard user file\n.')
+
+        # Check last file modification time.
+        start = time.perf_counter()
         try:
-            file_mod_time = os.path.getmtime(user_path_default)
-            file_name = user_path_default
-        except OSError:
-            abort(500)
-    if last_user_time == file_mod_time and user_list != []:
-        return user_list
-
-    # Read user file, store info as list of lists.
-    user_list = []
-    last_user_time = file_mod_time
+            file_name, file_mod_time = find_file(user_path, user_path_default)
+            if time_stages:
+                record_stage('file_check', start)
+            if user_snapshot.file_time == file_mod_time and not user_snapshot.error:
+                count_metric(file_checks, ('users', 'unchanged'))
+                return False
+            count_metric(file_checks, ('users', 'changed'))
+            cache_key = source_key(file_name) if index_cache_dir is not None else None  # Taken before reading.
+            snapshot = load_file('users', file_name, file_mod_time, user_snapshot, user_changes.version + 1, cache_key)
+        except (OSError, ValueError, IndexError):
+            user_snapshot = Snapshot(error=True, version=user_changes.version)
+            count_metric(reload_failures, 'users')
+            return True
+
+        # Publish the new snapshot with a single assignment.
+        user_changes.record(snapshot)  # Log before publishing, so the log is never behind a response's version.
+        user_snapshot = snapshot
+        query_cache.invalidate('users', snapshot.version)
+        observe_metric(reload_latency, 'users', time.perf_counter() - start)
+        if cache_key is not None and not isinstance(snapshot, MappedSnapshot):
+            save_cached_snapshot(snapshot, cache_key, 'users')  # After publishing, so requests don't wait for it.
+    finally:
+        user_reload_lock.release()
+
+    return True
+
+
+def refresh_groups(blocking=True):
+    """
+    Check last group file modify time.
+    If different than the current snapshot's, read the file and publish a new group snapshot.
+    If blocking is False and another thread is already reloading, return without waiting.
+    Return True if a new snapshot was published.
+    """
+
+    global group_snapshot
+
+    if not group_reload_lock.acquire(blocking):
+        return False
     try:
-        with open(file_name, 'r', newline='') as passwd:
-            reader = csv.reader(passwd, delimiter=':')
-            for row in reader:
-                row.pop(1)  # Remove password field.
-                if len(row) != len(user_cols):
-                    raise IndexError
-                user_list.append(row)
-    except (OSError, IndexError):
-        abort(500)
 
-    return user_list
+        # Check last file modification time.
+        start = time.perf_counter()
+        try:
+            file_name, file_mod_time = find_file(group_path, group_path_default)
+            if time_stages:
+                record_stage('file_check', start)
+            if group_snapshot.file_time == file_mod_time and not group_snapshot.error:
+                count_metric(file_checks, ('groups', 'unchanged'))
+                return False
+            count_metric(file_checks, ('groups', 'changed'))
+            cache_key = source_key(file_name) if index_cache_dir is not None else None  # Taken before reading.
+            snapshot = load_file('groups', file_name, file_mod_time, group_snapshot, group_changes.version + 1,
+                                 cache_key)
+        except (OSError, ValueError, IndexError):
+            group_snapshot = Snapshot(error=True, version=group_changes.version)
+            count_metric(reload_failures, 'groups')
+            return True
+
+        # Publish the new snapshot with a single assignment.
+        group_changes.record(snapshot)  # Log before publishing, so the log is never behind a response's version.
+        group_snapshot = snapshot
+        query_cache.invalidate('groups', snapshot.version)
+        observe_metric(reload_latency, 'groups', time.perf_counter() - start)
+        if cache_key is not None and not isinstance(snapshot, MappedSnapshot):
+            save_cached_snapshot(snapshot, cache_key, 'groups')  # After publishing, so requests don't wait for it.
+    finally:
+        group_reload_lock.release()
+
+    return True
+
+
+class Source:
+    """
+    A named pair of passwd and group files, served under /sources/<name>/ with the same routes as the main files.
+    Each kind ('users' or 'groups') has its own snapshot, change log and reload lock, see refresh_source().
+    """
+
+    def __init__(self, name, user_path, group_path, scanned=False):
+        self.name = name
+        self.paths = {'users': user_path, 'groups': group_path}
+        self.snapshots = {'users': Snapshot(), 'groups': Snapshot()}
+        self.changes = {'users': ChangeLog(), 'groups': ChangeLog()}
+        self.reload_locks = {'users': threading.Lock(), 'groups': threading.Lock()}
+        self.scanned = scanned  # Found in sources_dir, so removed when its directory goes.
 
+    def label(self, kind):
+        """Return the name of one of the source's files in metrics and query cache keys."""
 
-def read_groups():
+        return 'sources/{0}/{1}'.format(self.name, kind)
+
+
+def add_source(name, user_path, group_path, scanned=False):
+    """Add (or replace) a source serving a passwd and a group file under /sources/<name>/. Return the Source."""
+
+    source = Source(name, user_path, group_path, scanned)
+    with sources_lock:
+        old = sources.get(name)
+        sources[name] = source
+    if old is not None:
+        index_source_uids(name, old.snapshots['users'], Snapshot())
+
+    return source
+
+
+def remove_source(name):
+    """Stop serving a source."""
+
+    with sources_lock:
+        source = sources.pop(name, None)
+    if source is not None:
+        index_source_uids(name, source.snapshots['users'], Snapshot())
+
+
+def scan_sources():
     """
-    Check last group file modify time.
-    If different than stored time, read the file.
-    Return group info.
+    Add a source for each directory in sources_dir holding passwd and group files, named after the directory,
+    and remove the sources added this way whose directories are gone.
     """
 
-    global last_group_time
-    global group_list
+    if sources_dir is None:
+        return
+    try:
+        names = os.listdir(sources_dir)
+    except OSError:
+        names = []
+
+    found = set()
+    for name in names:
+        user_file = os.path.join(sources_dir, name, 'passwd')
+        group_file = os.path.join(sources_dir, name, 'group')
+        if os.path.isfile(user_file) and os.path.isfile(group_file):
+            found.add(name)
+            if name not in sources:
+                add_source(name, user_file, group_file, scanned=True)
+    for name, source in list(sources.items()):
+        if source.scanned and name not in found:
+            remove_source(name)
+
+
+def get_source(name):
+    """Return the source with name, scanning sources_dir for new ones unless the file watcher does. 404 if none."""
+
+    source = sources.get(name)
+    if source is None and not watcher_running():
+        scan_sources()
+        source = sources.get(name)
+    if source is None:
+        abort(404)
+
+    return source
 
-    # Check last file modification time.
-    file_name = None
-    file_mod_time = None
+
+def read_source(source, kind):
+    """Return a source's snapshot of kind. Unless the file watcher is running, check the file for changes first."""
+
+    if not watcher_running() or source.snapshots[kind].file_time is None:
+        refresh_source(source, kind, blocking=source.snapshots[kind].file_time is None)
+    return source.snapshots[kind]
+
+
+def refresh_sources():
+    """Look for new sources, then re-read the files of all sources that changed."""
+
+    scan_sources()
+    for source in list(sources.values()):
+        refresh_source(source, 'users')
+        refresh_source(source, 'groups')
+
+
+def refresh_source(source, kind, blocking=True):
+    """
+    Check the modify time of a source's 'users' or 'groups' file, and read it and publish a new snapshot
+    if it changed, like refresh_users() and refresh_groups(). Rows are shared with other sources through
+    row_pools. Return True if a new snapshot was published.
+    """
+
+    lock = source.reload_locks[kind]
+    if not lock.acquire(blocking):
+        return False
     try:
-        file_mod_time = os.path.getmtime(group_path)
-        file_name = group_path
-    except (OSError, TypeError):
-        # print('\n\tError accessing provided group file.')
-        # print('\tDefaulting to standard group file.\n')
+
+        # Check last file modification time.
+        label = source.label(kind)
+        changes = source.changes[kind]
+        previous = source.snapshots[kind]
+        start = time.perf_counter()
         try:
-            file_mod_time = os.path.getmtime(group_path_default)
-            file_name = group_path_default
-        except OSError:
-            abort(500)
-    if last_group_time == file_mod_time and group_list != []:
-        return group_list
-
-    # Read group file, store info as list of lists.
-    group_list = []
-    last_group_time = file_mod_time
-    try:
-        with open(file_name, 'r', newline='') as group:
-            reader = csv.reader(group, delimiter=':')
-            for row in reader:
-                row.pop(1)  # Remove password field.
-                if len(row) != len(group_cols):
-                    raise IndexError
-                row[-1] = row[-1].split(',')  # Split member field from CSV to list.
-                row[-1] = [item.replace(' ', '') for item in row[-1]]  # Trim whitespace.
-                if len(row[-1]) == 1 and '' in row[-1]:
-                    row[-1] = []  # Handle empty list case.
-                group_list.append(row)
-    except (OSError, IndexError):
-        abort(500)
+            file_name = source.paths[kind]
+            file_mod_time = os.path.getmtime(file_name)
+            if previous.file_time == file_mod_time and not previous.error:
+                count_metric(file_checks, (label, 'unchanged'))
+                return False
+            count_metric(file_checks, (label, 'changed'))
+            cache_key = source_key(file_name) if index_cache_dir is not None else None  # Taken before reading.
+            snapshot = load_file(kind, file_name, file_mod_time, previous, changes.version + 1, cache_key,
+                                 row_pools[kind])
+        except (OSError, ValueError, IndexError):
+            source.snapshots[kind] = Snapshot(error=True, version=changes.version)
+            count_metric(reload_failures, label)
+            return True
+
+        # Publish the new snapshot with a single assignment.
+        changes.record(snapshot)
+        source.snapshots[kind] = snapshot
+        if kind == 'users':
+            index_source_uids(source.name, previous, snapshot)
+        query_cache.invalidate(label, snapshot.version)
+        observe_metric(reload_latency, label, time.perf_counter() - start)
+        prune_row_pool(kind)
+        if cache_key is not None and not isinstance(snapshot, MappedSnapshot):
+            save_cached_snapshot(snapshot, cache_key, kind)
+    finally:
+        lock.release()
+
+    return True
+
+
+def index_source_uids(name, old, new):
+    """Update uid_sources for a source's user snapshot changing from old to new."""
+
+    old_uids = set(old.index.get('uid', ()))
+    new_uids = set(new.index.get('uid', ()))
+    with sources_lock:
+        for uid in old_uids - new_uids:
+            names = uid_sources.get(uid)
+            if names is not None:
+                names.discard(name)
+                if not names:
+                    del uid_sources[uid]
+        for uid in new_uids - old_uids:
+            uid_sources.setdefault(uid, set()).add(name)
+
+
+def prune_row_pool(kind):
+    """Rebuild a row pool from the sources' current rows once most of its rows are no longer used."""
+
+    with sources_lock:
+        snapshots = [source.snapshots[kind] for source in sources.values()]
+    live_rows = sum(len(snapshot.rows) for snapshot in snapshots)
+    if len(row_pools[kind]) <= 2 * live_rows + 1000:
+        return
+    pool = {}
+    for snapshot in snapshots:
+        for row in snapshot.rows:
+            pool.setdefault(row, row)
+    row_pools[kind] = pool
+
+
+def change_log(kind):
+    """Return (change log, refresh function) for the request's 'users' or 'groups' file."""
+
+    if 'source' in g:
+        return g.source.changes[kind], partial(refresh_source, g.source, kind)
+    if kind == 'users':
+        return user_changes, refresh_users
+    return group_changes, refresh_groups
+
+
+def route_rule():
+    """Return the request's route rule without any source prefix, or None if no route matched."""
+
+    if request.url_rule is None:
+        return None
+    rule = request.url_rule.rule
+    if rule.startswith(source_prefix):
+        rule = rule[len(source_prefix):]
+
+    return rule
+
+
+def file_label(kind):
+    """Return the name of the request's 'users' or 'groups' file in metrics and query cache keys."""
+
+    return g.source.label(kind) if 'source' in g else kind
+
+
+def load_file(kind, file_name, file_mod_time, previous, version, cache_key=None, pool=None):
+    """
+    Return a new 'users' or 'groups' snapshot of a file: from the index cache if it has cache_key's
+    version of the file (see load_cached_snapshot()), otherwise read (see read_rows()) and indexed.
+    Raise OSError, ValueError or IndexError if the file can't be read or has a malformed line.
+    """
 
-    return group_list
+    snapshot = load_cached_snapshot(cache_key, kind, file_mod_time, version)
+    if snapshot is not None:
+        stage_start = time.perf_counter()
+        snapshot.decode_rows(pool)  # Queries and formats read rows many times; decode them once.
+        if time_stages:
+            record_stage('file_parse', stage_start)
+        return snapshot
+
+    stage_start = time.perf_counter()
+    rows, bodies, source = read_rows(file_name, previous, parse_user_line if kind == 'users' else parse_group_line,
+                                     pool)
+    if time_stages:
+        record_stage('file_parse', stage_start)
+    stage_start = time.perf_counter()
+    if kind == 'users':
+        index = build_index(rows, user_index_cols)
+        member_index = {}
+    else:
+        index = build_index(rows, group_index_cols)
+        member_index = build_member_index(rows)
+    if time_stages:
+        record_stage('index_build', stage_start)
+    stage_start = time.perf_counter()
+    snapshot = Snapshot(rows, index, member_index, file_mod_time, bodies=bodies, source=source, version=version)
+    if time_stages:
+        record_stage('json_serialize', stage_start)
 
+    return snapshot
 
-def convert_to_int(s):
-    """Convert any object to int if possible, otherwise return original object."""
+
+def read_rows(file_name, previous, parse_line, pool=None):
+    """
+    Read a user or group file and return (rows, bodies, file contents).
+    Lines that are unchanged at the start and end of the file since the previous snapshot keep
+    their parsed rows, and their JSON bodies are returned in bodies (None for re-parsed rows).
+    Only the changed region in between goes through parse_line, so an append only parses new lines.
+    Parsed rows equal to one in pool (a dict of rows) are replaced by it, so other files share it.
+    Raise OSError, ValueError or IndexError if the file can't be read or has a malformed line.
+    """
+
+    # Read a private copy, as the next reload diffs against it and the file may be changed in place.
+    with open(file_name, 'rb') as file:
+        source = file.read()
+    if not source:
+        return (), [], b''
+
+    old_source = previous.source if not previous.error else b''
+    old_rows = previous.rows if not previous.error else ()
+
+    # Find the unchanged lines at the start of the file.
+    prefix_end = common_prefix(old_source, source)
+    prefix_end = old_source.rfind(b'\n', 0, prefix_end) + 1  # Back up to a line start.
+    if prefix_end == len(old_source) == len(source):
+        return old_rows, [previous.body(i) for i in range(len(old_rows))], source
+    prefix_rows = old_source.count(b'\n', 0, prefix_end)
+
+    # Find the unchanged lines at the end of the file, not overlapping the start.
+    suffix_len = common_suffix(old_source, source, min(len(old_source), len(source)) - prefix_end)
+    suffix_start = len(old_source) - suffix_len
+    if not (line_start(old_source, suffix_start, prefix_end) and
+            line_start(source, len(source) - suffix_len, prefix_end)):
+        suffix_start = old_source.find(b'\n', suffix_start) + 1  # Move on to a line start.
+        if suffix_start == 0:
+            suffix_start = len(old_source)
+    suffix_len = len(old_source) - suffix_start
+    suffix_rows = count_lines(old_source[suffix_start:])
+
+    # Parse the changed region.
+    values = {}  # Shares one object per distinct parsed value, e.g. gid.
+    changed = source[prefix_end:len(source) - suffix_len]
+    new_rows = [parse_line(line, values) for line in split_lines(changed.decode())]
+    if pool is not None:
+        new_rows = [pool.setdefault(row, row) for row in new_rows]
+
+    rows = old_rows[:prefix_rows] + tuple(new_rows) + old_rows[len(old_rows) - suffix_rows:]
+    bodies = [previous.body(i) for i in range(prefix_rows)]
+    bodies.extend([None] * len(new_rows))
+    bodies.extend(previous.body(i) for i in range(len(old_rows) - suffix_rows, len(old_rows)))
+
+    return rows, bodies, source
+
+
+def line_start(data, position, region_start):
+    """Return True if position in data is the start of a line, given region_start is one."""
+
+    return position == region_start or data[position - 1:position] == b'\n'
+
+
+def split_lines(text):
+    """Return the lines of a decoded file region as a list, without line endings."""
+
+    if not text:
+        return []
+    lines = text.split('\n')
+    if lines[-1] == '':
+        lines.pop()  # Last line ended with a newline.
+    return [line[:-1] if line.endswith('\r') else line for line in lines]
+
+
+def count_lines(data):
+    """Return the number of lines in a file region (bytes)."""
+
+    return data.count(b'\n') + (1 if data and not data.endswith(b'\n') else 0)
+
+
+def common_prefix(a, b):
+    """Return the length of the common prefix of two bytes objects."""
+
+    return common_length(memoryview(a), memoryview(b), min(len(a), len(b)), False)
+
+
+def common_suffix(a, b, limit):
+    """Return the length of the common suffix of two bytes objects, up to limit."""
+
+    return common_length(memoryview(a), memoryview(b), max(limit, 0), True)
+
+
+def common_length(a, b, limit, from_end):
+    """
+    Return how many leading (or trailing, if from_end) bytes of a and b match, up to limit.
+    Compares 64 KiB blocks, then narrows down the first mismatching block by bisection.
+    """
+
+    def part(view, lo, hi):
+        if from_end:
+            return view[len(view) - hi:len(view) - lo]
+        return view[lo:hi]
+
+    lo = 0
+    while lo < limit:
+        hi = min(lo + 65536, limit)
+        if part(a, lo, hi) != part(b, lo, hi):
+            while hi - lo > 1:
+                mid = (lo + hi) // 2
+                if part(a, lo, mid) == part(b, lo, mid):
+                    lo = mid
+                else:
+                    hi = mid
+            return lo
+        lo = hi
+
+    return limit
+
+
+def parse_user_line(line, values):
+    """
+    Return a passwd line as a User record. Raise IndexError if it doesn't have 7 fields.
+    values is a dict used to share uid/gid objects between rows.
+    """
+
+    row = line.split(':')
+    if len(row) != len(user_cols) + 1:
+        raise IndexError
+    name, _, uid, gid, comment, home, shell = row  # Drop password field.
+
+    uid = convert_to_int(uid)
+    gid = convert_to_int(gid)
+
+    return User(sys.intern(name), values.setdefault(uid, uid), values.setdefault(gid, gid),
+                sys.intern(comment), sys.intern(home), sys.intern(shell))
+
+
+def parse_group_line(line, values):
+    """
+    Return a group line as a Group record. Raise IndexError if it doesn't have 4 fields.
+    values is a dict used to share gid objects between rows.
+    """
+
+    row = line.split(':')
+    if len(row) != len(group_cols) + 1:
+        raise IndexError
+    name, _, gid, members = row  # Drop password field.
+    members = members.split(',')  # Split member field from CSV to list.
+    members = tuple(sys.intern(item.replace(' ', '')) for item in members)  # Trim whitespace.
+    if len(members) == 1 and '' in members:
+        members = ()  # Handle empty list case.
+
+    gid = convert_to_int(gid)
+
+    return Group(sys.intern(name), values.setdefault(gid, gid), members)
+
+
+def find_file(path, path_default):
+    """
+    Return (file name, modify time) of path, falling back to path_default if path is unset or missing.
+    Raise OSError if neither can be accessed.
+    """
 
     try:
-        return int(s)
-    except (ValueError, TypeError):
-        return s
+        return path, os.path.getmtime(path)
+    except (OSError, TypeError):
+        # print('\n\tError accessing provided file.')
+        # print('\tDefaulting to standard file.\n')
+        return path_default, os.path.getmtime(path_default)
+
+
+class Snapshot:
+    """
+    One fully built version of a user or group file: rows, lookup indexes and cached JSON bodies.
+    A snapshot is never changed after it is built. Reloads publish a new one with a single
+    assignment to user_snapshot/group_snapshot, so readers never lock or see a half-built version.
+    """
+
+    __slots__ = ['rows', 'index', 'member_index', 'all_body', 'body_starts', 'file_time', 'error', 'source',
+                 'version', 'sorted_indexes', 'compressed', 'format_bodies']
+
+    def __init__(self, rows=(), index=None, member_index=None, file_time=None, error=False,
+                 bodies=None, source=b'', version=0):
+        self.rows = rows  # Tuple of User or Group records, in file order.
+        self.index = index or {}  # Maps each indexed column to {value: row positions}, see lookup().
+        self.member_index = member_index or {}  # Maps member name to group positions, see lookup().
+        self.file_time = file_time  # Modify time of the file this was read from.
+        self.error = error  # True if the file couldn't be found or read.
+        self.source = source  # Copy of the file contents (one per snapshot), compared against on the next reload.
+        self.version = version  # Change log version, see ChangeLog.
+        self.sorted_indexes = {}  # Built on first use by range and prefix queries, see sorted_index().
+        self.compressed = {}  # Maps (format, row position or None for the listing, encoding) to body.
+        self.format_bodies = {}  # Bodies in formats other than JSON, made on first use, see format_body().
+
+        # Serialize the full listing once, reusing any given row bodies; row bodies are slices of it.
+        if bodies is None:
+            bodies = [None] * len(rows)
+        bodies = [dumps(row.to_json()).encode() if body is None else body for row, body in zip(rows, bodies)]
+        self.all_body = join_json(bodies)
+        self.body_starts = array('Q')  # Offset of each row body in all_body, plus one past the end.
+        position = 1
+        for body in bodies:
+            self.body_starts.append(position)
+            position += len(body) + 2
+        self.body_starts.append(position)
+
+    def body(self, i):
+        """Return the serialized JSON body of row i."""
+
+        return self.all_body[self.body_starts[i]:self.body_starts[i + 1] - 2]
+
+
+class User:
+    """One passwd row, without the password field. uid and gid are ints if the file has integers."""
+
+    __slots__ = user_cols
+
+    def __init__(self, name, uid, gid, comment, home, shell):
+        self.name = name
+        self.uid = uid
+        self.gid = gid
+        self.comment = comment
+        self.home = home
+        self.shell = shell
+
+    def __eq__(self, other):
+        return type(other) is User and all(getattr(self, col) == getattr(other, col) for col in user_cols)
+
+    def __hash__(self):
+        return hash((self.name, self.uid, self.gid, self.comment, self.home, self.shell))
+
+    def to_json(self):
+        """Return the user as a dict keyed by output column name."""
+
+        return {'name': self.name, 'uid': self.uid, 'gid': self.gid,
+                'comment': self.comment, 'home': self.home, 'shell': self.shell}
+
+    @classmethod
+    def from_json(cls, values):
+        """Return a user from the dict returned by to_json()."""
+
+        return cls(values['name'], values['uid'], values['gid'], values['comment'], values['home'], values['shell'])
+
+
+class Group:
+    """One group row, without the password field. gid is an int if the file has an integer."""
+
+    __slots__ = ['name', 'gid', 'members']
+
+    def __init__(self, name, gid, members):
+        self.name = name
+        self.gid = gid
+        self.members = members  # Tuple of member names.
+
+    def __eq__(self, other):
+        return type(other) is Group and (self.name, self.gid, self.members) == (other.name, other.gid, other.members)
+
+    def __hash__(self):
+        return hash((self.name, self.gid, self.members))
+
+    def to_json(self):
+        """Return the group as a dict keyed by output column name."""
+
+        return {'name': self.name, 'gid': self.gid, 'members': list(self.members)}
+
+    @classmethod
+    def from_json(cls, values):
+        """Return a group from the dict returned by to_json()."""
+
+        return cls(values['name'], values['gid'], tuple(values['members']))
+
+
+class MappedSnapshot:
+    """
+    A snapshot read from a binary snapshot file (see write_snapshot_file()) through a read-only mmap.
+    Has the same attributes as Snapshot, but bodies, offsets and indexes stay in the mapped file, so
+    processes mapping the same file share one copy in the page cache. Rows are decoded from their
+    JSON bodies when read, unless decode_rows() was called, and bodies are copied out of the file per response.
+    """
+
+    __slots__ = ['rows', 'index', 'member_index', 'body_view', 'body_starts', 'file_time', 'error', 'source',
+                 'version', 'meta', 'sorted_indexes', 'compressed', 'format_bodies']
+
+    def __init__(self, data, header, data_start):
+        self.file_time = header['file_time']
+        self.error = header['error']
+        self.version = header['version']
+        self.meta = header['meta']  # Extra header values given to write_snapshot_file().
+        self.source = b''  # Not kept, so the next reload of the source file parses it all.
+        self.sorted_indexes = {}
+        self.compressed = {}
+        self.format_bodies = {}
+        self.index = {}
+        self.member_index = {}
+        if self.error:
+            self.rows = ()
+            self.body_view = memoryview(b'[]')
+            self.body_starts = array('Q', [1])
+            return
+
+        view = memoryview(data)
+
+        def section(name, fmt='B'):
+            offset, length = header['sections'][name]
+            if data_start + offset + length > len(view):
+                raise ValueError('truncated snapshot file')
+            return view[data_start + offset:data_start + offset + length].cast(fmt)
+
+        def index_section(name):
+            return MappedIndex(section(name + '.key_starts', 'Q'), section(name + '.keys'),
+                               section(name + '.position_starts', 'Q'), section(name + '.positions', 'I'))
+
+        self.body_view = section('all_body')
+        self.body_starts = section('body_starts', 'Q')
+        self.rows = MappedRows(self, User if header['kind'] == 'users' else Group)
+        for col in header['index_cols']:
+            self.index[col] = index_section('index.' + col)
+        if 'member_index.keys' in header['sections']:
+            self.member_index = index_section('member_index')
+
+    @property
+    def all_body(self):
+        """The serialized JSON list of all rows, copied out of the file."""
+
+        return self.body_view.tobytes()
+
+    def body(self, i):
+        """Return the serialized JSON body of row i."""
+
+        return self.body_view[self.body_starts[i]:self.body_starts[i + 1] - 2].tobytes()
+
+    def decode_rows(self, pool=None):
+        """
+        Decode all rows once, into memory, so reading them costs no more than in a parsed Snapshot.
+        Rows equal to one in pool are replaced with it, like in read_rows().
+        """
+
+        if self.error:
+            return
+        row_class = self.rows.row_class
+        rows = (row_class.from_json(values) for values in loads(self.all_body))
+        if pool is not None:
+            rows = (pool.setdefault(row, row) for row in rows)
+        self.rows = tuple(rows)
+
+
+class MappedRows:
+    """Read-only sequence of the rows of a MappedSnapshot, each decoded from its JSON body when read."""
+
+    __slots__ = ['snapshot', 'row_class']
+
+    def __init__(self, snapshot, row_class):
+        self.snapshot = snapshot
+        self.row_class = row_class
+
+    def __len__(self):
+        return len(self.snapshot.body_starts) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return tuple(self[j] for j in range(*i.indices(len(self))))
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return self.row_class.from_json(loads(self.snapshot.body(i)))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+class MappedIndex:
+    """
+    Read-only {value: row positions} index in a snapshot file, searched by bisection over sorted keys
+    (see index_key()). Supports get() and items(), so it can be used with lookup() like an index dict.
+    """
+
+    __slots__ = ['key_starts', 'keys', 'position_starts', 'positions']
+
+    def __init__(self, key_starts, keys, position_starts, positions):
+        self.key_starts = key_starts  # Offset of each key in keys, plus one past the end.
+        self.keys = keys  # Sorted keys, concatenated.
+        self.position_starts = position_starts  # Offset of each key's positions in positions, plus the end.
+        self.positions = positions  # Row positions of each key in turn, in file order.
+
+    def __len__(self):
+        return len(self.key_starts) - 1
+
+    def get(self, value, default=None):
+        """Return the row positions of value, or default if it has no rows."""
+
+        key = index_key(value)
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == len(self) or self.key(lo) != key:
+            return default
+
+        return self.positions[self.position_starts[lo]:self.position_starts[lo + 1]]
+
+    def items(self):
+        """Yield (value, row positions) for each value, in key order."""
+
+        for i in range(len(self)):
+            yield index_value(self.key(i)), self.positions[self.position_starts[i]:self.position_starts[i + 1]]
+
+    def key(self, i):
+        """Return key i as bytes."""
+
+        return self.keys[self.key_starts[i]:self.key_starts[i + 1]].tobytes()
+
+
+def write_snapshot_file(snapshot, file_name, kind, **meta):
+    """
+    Write a Snapshot to file_name in the binary snapshot format, replacing any existing file atomically.
+    kind is 'users' or 'groups'; meta is stored in the header and returned as MappedSnapshot.meta.
+    The file is the magic bytes, the header length (8 bytes, little endian), a JSON header and then
+    8-byte aligned sections named in the header as [offset, length]: the JSON listing, the body offsets,
+    and for each index the sorted keys with their offsets and the row positions with their offsets.
+    """
+
+    sections = []
+    if not snapshot.error:
+        sections.append(('all_body', snapshot.all_body))
+        sections.append(('body_starts', snapshot.body_starts))
+        for col, col_index in snapshot.index.items():
+            sections.extend(pack_index('index.' + col, col_index))
+        if snapshot.member_index:
+            sections.extend(pack_index('member_index', snapshot.member_index))
+
+    header = {'format': snapshot_file_format, 'kind': kind, 'error': snapshot.error, 'file_time': snapshot.file_time,
+              'version': snapshot.version, 'index_cols': list(snapshot.index), 'meta': meta, 'sections': {}}
+    position = 0
+    for name, data in sections:
+        length = memoryview(data).nbytes
+        header['sections'][name] = [position, length]
+        position += length + -length % 8
+    header = dumps(header).encode()
+
+    temp_name = '{0}.{1}.tmp'.format(file_name, os.getpid())
+    try:
+        with open(temp_name, 'wb') as file:
+            file.write(snapshot_file_magic + len(header).to_bytes(8, 'little') + header)
+            file.write(b'\0' * (-file.tell() % 8))
+            for _, data in sections:
+                file.write(data)
+                file.write(b'\0' * (-memoryview(data).nbytes % 8))
+        os.replace(temp_name, file_name)  # Readers see the old file or the new one, never part of one.
+    except BaseException:
+        if os.path.exists(temp_name):
+            os.remove(temp_name)
+        raise
+
+
+def pack_index(name, col_index):
+    """Return the named sections of a snapshot file for an index dict, see write_snapshot_file()."""
+
+    key_starts = array('Q', [0])
+    keys = []
+    position_starts = array('Q', [0])
+    positions = array('I')
+    items = sorted(((index_key(value), found) for value, found in col_index.items()), key=lambda item: item[0])
+    for key, found in items:
+        keys.append(key)
+        key_starts.append(key_starts[-1] + len(key))
+        positions.extend(expand_positions(found))
+        position_starts.append(len(positions))
+
+    return [(name + '.key_starts', key_starts), (name + '.keys', b''.join(keys)),
+            (name + '.position_starts', position_starts), (name + '.positions', positions)]
+
+
+def map_snapshot_file(file_name):
+    """
+    Return a MappedSnapshot of a file written by write_snapshot_file().
+    Raise OSError if it can't be read, or ValueError if it isn't a snapshot file of the current format.
+    """
+
+    with open(file_name, 'rb') as file:
+        data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)  # Stays mapped after the file is closed.
+    if data[:len(snapshot_file_magic)] != snapshot_file_magic:
+        raise ValueError('not a snapshot file: ' + file_name)
+    header_start = len(snapshot_file_magic) + 8
+    header_end = header_start + int.from_bytes(data[header_start - 8:header_start], 'little')
+    header = loads(data[header_start:header_end])
+    if header.get('format') != snapshot_file_format:
+        raise ValueError('unsupported snapshot file format: ' + file_name)
+
+    return MappedSnapshot(data, header, header_end + -header_end % 8)
+
+
+def source_key(file_name):
+    """Return what identifies a version of a source file in the index cache: its path, size and modify time."""
+
+    stat = os.stat(file_name)
+    return {'path': os.path.abspath(file_name), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def cache_file_name(key, kind):
+    """Return the index cache file for a source file path and kind ('users' or 'groups')."""
+
+    name = hashlib.sha1(key['path'].encode('utf-8', 'surrogatepass')).hexdigest()[:16]
+    return os.path.join(index_cache_dir, '{0}.{1}.snapshot'.format(name, kind))
+
+
+def load_cached_snapshot(key, kind, file_time, version):
+    """
+    Return the snapshot cached for the source file version in key (see source_key()) as a MappedSnapshot
+    with the given change log version. Return None if key is None, or there is no usable cache file for it.
+    """
+
+    if key is None:
+        return None
+    try:
+        snapshot = map_snapshot_file(cache_file_name(key, kind))
+    except (OSError, ValueError):
+        return None
+    if snapshot.error or snapshot.meta != key or snapshot.file_time != file_time:
+        return None
+    snapshot.version = version  # Not published yet.
+
+    return snapshot
+
+
+def save_cached_snapshot(snapshot, key, kind):
+    """Write a snapshot to the index cache for the source file version in key. Errors are ignored."""
+
+    try:
+        os.makedirs(index_cache_dir, exist_ok=True)
+        write_snapshot_file(snapshot, cache_file_name(key, kind), kind, **key)
+    except OSError:
+        pass  # The cache is optional; the file is parsed again next time.
+
+
+def index_key(value):
+    """Return an index value as bytes for a snapshot file index, keeping int 1 and str '1' apart."""
+
+    if isinstance(value, int):
+        return b'i' + str(value).encode()
+    return b's' + value.encode('utf-8', 'surrogatepass')
+
+
+def index_value(key):
+    """Return the index value for a key made by index_key()."""
+
+    if key[:1] == b'i':
+        return int(key[1:])
+    return key[1:].decode('utf-8', 'surrogatepass')
+
+
+class ChangeLog:
+    """
+    Bounded history of the rows added, modified and removed between consecutive snapshots of one file.
+    Each published snapshot gets the next version number. Versions start from the time in
+    milliseconds, so versions from an earlier run of the service are never reused.
+    Snapshots mapped from a loader process keep its version numbers, which may skip some.
+    """
+
+    def __init__(self):
+        self.deltas = deque(maxlen=change_history)  # (previous version, version, delta), see diff_snapshots().
+        self.last = None  # Last recorded snapshot.
+        self.version = int(time.time() * 1000)
+        self.condition = threading.Condition()  # Notified on each recorded version.
+
+    def record(self, snapshot):
+        """Log the changes from the last recorded snapshot to this one, and wake waiting requests."""
+
+        delta = diff_snapshots(self.last, snapshot) if self.last is not None else None
+        with self.condition:
+            if delta is not None:
+                self.deltas.append((self.last.version, snapshot.version, delta))
+            self.last = snapshot
+            self.version = snapshot.version
+            self.condition.notify_all()
+
+    def wait(self, version, timeout):
+        """Wait up to timeout seconds for a version other than version to be recorded."""
+
+        with self.condition:
+            self.condition.wait_for(lambda: self.version != version, timeout)
+
+    def since(self, version):
+        """
+        Return (current version, {name: (kind, body)}) merging all changes after version.
+        kind is 'added', 'modified' or 'removed' (body None), as in diff_snapshots().
+        The dict is None if the changes after version are no longer (or were never) logged.
+        """
+
+        with self.condition:
+            current = self.version
+            deltas = list(self.deltas)
+        if version != current and not any(previous == version for previous, _, _ in deltas):
+            return current, None
+        deltas = [delta for _, delta_version, delta in deltas if delta_version > version]
+
+        merged = {}
+        for delta in deltas:
+            for name, (kind, body) in delta.items():
+                old_kind = merged[name][0] if name in merged else None
+                if old_kind == 'added' and kind == 'removed':
+                    del merged[name]  # Came and went.
+                elif old_kind == 'added':
+                    merged[name] = ('added', body)
+                elif old_kind == 'removed' and kind == 'added':
+                    merged[name] = ('modified', body)  # Went and came back.
+                else:
+                    merged[name] = (kind, body)
+
+        return current, merged
+
+
+def diff_snapshots(old, new):
+    """
+    Return {name: (kind, body)} for the rows added, modified or removed from old to new snapshot.
+    kind is 'added', 'modified' or 'removed', body is the new cached JSON body or None if removed.
+    Rows are matched by name, from the name index; if a name is listed twice, its last row counts.
+    """
+
+    old_names = last_positions(old.index['name'])
+    new_names = last_positions(new.index['name'])
+
+    # Compare cached bodies, so rows of mapped snapshots are never decoded.
+    delta = {}
+    for name, i in new_names.items():
+        j = old_names.get(name)
+        if j is None:
+            delta[name] = ('added', new.body(i))
+        else:
+            body = new.body(i)
+            if body != old.body(j):
+                delta[name] = ('modified', body)
+    for name in old_names:
+        if name not in new_names:
+            delta[name] = ('removed', None)
+
+    return delta
+
+
+def last_positions(col_index):
+    """Return {value: position of its last row} from an index."""
+
+    return {value: found if isinstance(found, int) else found[-1] for value, found in col_index.items()}
+
+
+class FileWatcher(threading.Thread):
+    """
+    Background thread that re-reads the user and group files when they change.
+    Waits on inotify events for the files' directories (or dirs) on Linux, otherwise polls.
+    Either way the files are also checked every poll_interval seconds.
+    Subclasses can override refresh() to follow other files.
+    """
+
+    def __init__(self, poll_interval, use_inotify=True, dirs=None):
+        super().__init__(name='file-watcher', daemon=True)
+        self.poll_interval = poll_interval
+        self.stop_event = threading.Event()
+        if use_inotify:
+            self.inotify_fd = open_inotify(watch_dirs() if dirs is None else dirs)  # Open now so no change is missed.
+        else:
+            self.inotify_fd = None
+        self.wake_read_fd, self.wake_write_fd = os.pipe()  # Written to by stop() to end an inotify wait.
+
+    def run(self):
+        try:
+            while not self.stop_event.is_set():
+                if self.inotify_fd is None:
+                    self.stop_event.wait(self.poll_interval)
+                else:
+                    wait_inotify(self.inotify_fd, self.wake_read_fd, self.poll_interval)
+                if not self.stop_event.is_set():
+                    self.refresh()
+        finally:
+            if self.inotify_fd is not None:
+                os.close(self.inotify_fd)
+
+    def refresh(self):
+        """Re-read the user and group files, and those of any sources, if they changed."""
+
+        refresh_users()
+        refresh_groups()
+        refresh_sources()
+
+    def stop(self):
+        """Stop the thread and wait for it to exit."""
+
+        self.stop_event.set()
+        os.write(self.wake_write_fd, b'\0')
+        if self.is_alive():
+            self.join()
+        os.close(self.wake_read_fd)
+        os.close(self.wake_write_fd)
+
+
+def start_watcher(poll_interval=None, use_inotify=True):
+    """Load both files, then start the file watcher so requests no longer check the files themselves."""
+
+    global file_watcher
+
+    stop_watcher()
+    file_watcher = FileWatcher(watch_poll_interval if poll_interval is None else poll_interval, use_inotify)
+    refresh_users()
+    refresh_groups()
+    refresh_sources()
+    file_watcher.start()
+
+    return file_watcher
+
+
+def stop_watcher():
+    """Stop the file watcher if it is running; requests go back to checking the files themselves."""
+
+    global file_watcher
+
+    if file_watcher is not None:
+        file_watcher.stop()
+        file_watcher = None
+
+
+def watcher_running():
+    """Return True if the file watcher thread is keeping the user and group info current."""
+
+    return file_watcher is not None and file_watcher.is_alive()
+
+
+def watch_dirs():
+    """
+    Return the existing directories that hold the configured and default user/group files,
+    and those of any sources (plus sources_dir, for new sources).
+    """
+
+    dirs = []
+    paths = [user_path, user_path_default, group_path, group_path_default]
+    paths.extend(path for source in list(sources.values()) for path in source.paths.values())
+    if sources_dir is not None:
+        paths.append(os.path.join(sources_dir, 'passwd'))  # Watches sources_dir itself.
+    for path in paths:
+        if path is not None:
+            path_dir = os.path.dirname(os.path.abspath(path))
+            if os.path.isdir(path_dir) and path_dir not in dirs:
+                dirs.append(path_dir)
+
+    return dirs
+
+
+def open_inotify(dirs):
+    """Return an inotify file descriptor watching dirs for file changes, or None if inotify is unavailable."""
+
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    for path_dir in dirs:
+        libc.inotify_add_watch(fd, path_dir.encode(), inotify_mask)
+
+    return fd
+
+
+def wait_inotify(fd, wake_fd, timeout):
+    """Wait up to timeout seconds for inotify events or data on wake_fd, then discard any events."""
+
+    readable, _, _ = select.select([fd, wake_fd], [], [], timeout)
+    if fd not in readable:
+        return
+    time.sleep(inotify_settle_time)  # Let a burst of events for one write arrive together.
+    try:
+        while os.read(fd, 4096):
+            pass
+    except BlockingIOError:
+        pass
+
+
+def build_index(rows, index_cols):
+    """Return {column: {value: row positions}} for each indexed column, keeping file order. See compact_positions()."""
+
+    index = {}
+    for col in index_cols:
+        col_index = {}
+        for i, row in enumerate(rows):
+            col_index.setdefault(getattr(row, col), []).append(i)
+        index[col] = {value: compact_positions(positions) for value, positions in col_index.items()}
+
+    return index
+
+
+def build_member_index(groups):
+    """Return {member name: group positions}, keeping file order. See compact_positions()."""
+
+    index = {}
+    for i, group in enumerate(groups):
+        for member in group.members:
+            groups_for_member = index.setdefault(member, [])
+            if not groups_for_member or groups_for_member[-1] != i:
+                groups_for_member.append(i)  # Skip members listed twice in one group.
+
+    return {member: compact_positions(positions) for member, positions in index.items()}
+
+
+def compact_positions(positions):
+    """Return a list of row positions as an int if there is only one, otherwise as an array of ints."""
+
+    if len(positions) == 1:
+        return positions[0]
+    return array('I', positions)
+
+
+def lookup(col_index, value):
+    """Return the row positions stored for value in an index, as a sequence."""
+
+    return expand_positions(col_index.get(value, ()))
+
+
+def expand_positions(found):
+    """Return row positions stored in an index (see compact_positions()) as a sequence."""
+
+    if isinstance(found, int):
+        return (found,)
+    return found
+
+
+def get_conditions(cols, int_cols, members=False):
+    """
+    Return the search conditions in the querystring args as a list of (column, operator, value).
+    For each column: col=value (exact match), col_in=a,b (any of; also repeatable), col_prefix=text and
+    col_regex=pattern (searched in the value), plus col_gt/col_gte/col_lt/col_lte=number for int columns
+    (which take no col_prefix).
+    With members: member=name (repeatable, all of) and member_any=a,b (any of; also repeatable).
+    Other args are ignored. Abort with 400 on a non-integer range bound, a prefix on an int column,
+    or an invalid or refused regex.
+    """
+
+    conditions = []
+    for col in cols:
+        value = request.args.get(col)
+        if value is not None:
+            conditions.append((col, 'eq', convert_to_int(value) if col in int_cols else value))
+        values = get_list_arg(col + '_in')
+        if values is not None:
+            conditions.append((col, 'in', frozenset(convert_to_int(v) if col in int_cols else v for v in values)))
+        value = request.args.get(col + '_prefix')
+        if value is not None:
+            if col in int_cols:
+                abort(400)  # Use a range instead.
+            conditions.append((col, 'prefix', value))
+        value = request.args.get(col + '_regex')
+        if value is not None:
+            conditions.append((col, 'regex', compile_regex(value)))
+        if col in int_cols:
+            for op in range_ops:
+                value = request.args.get(col + '_' + op)
+                if value is not None:
+                    try:
+                        conditions.append((col, op, int(value)))
+                    except ValueError:
+                        abort(400)
+
+    if members:
+        for member in request.args.getlist('member'):
+            conditions.append(('members', 'has', member))
+        values = get_list_arg('member_any')
+        if values is not None:
+            conditions.append(('members', 'has_any', frozenset(values)))
+
+    return conditions
+
+
+def compile_regex(pattern):
+    """
+    Return a compiled regex for a col_regex arg. Abort with 400 if it is invalid or too long.
+    Uses re2, which runs in linear time on any pattern, if installed. Otherwise Python's re is used,
+    and patterns that could backtrack badly in it are refused, see check_regex().
+    """
+
+    if len(pattern) > regex_max_length:
+        abort(400)
+    if re2 is not None:
+        options = re2.Options()
+        options.log_errors = False
+        try:
+            return re2.compile(pattern, options)
+        except re2.error:
+            abort(400)
+    if not check_regex(pattern):
+        abort(400)
+    try:
+        return re.compile(pattern)
+    except re.error:
+        abort(400)
+
+
+def check_regex(pattern):
+    """
+    Return False if a regex could backtrack badly in Python's re: if it has a backreference,
+    more than regex_max_repeats variable-count quantifiers (*, +, ? or {m,n}), or a quantifier other than
+    {1} or {0,1} on a group holding a quantifier or alternation (like "(.*)*", "(a|a)+" or "(.?){25}").
+    """
+
+    repeats = 0
+    groups = [False]  # For each open group, whether it holds a quantifier or alternation.
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        inner = False
+        if char == '\\':
+            if pattern[i + 1:i + 2] in tuple('123456789'):
+                return False  # Backreference.
+            i += 1
+        elif char == '[':
+            i += 2 if pattern.startswith('[^', i) else 1
+            i += pattern.startswith(']', i)  # A leading ] is a literal.
+            while i < len(pattern) and pattern[i] != ']':
+                i += 2 if pattern[i] == '\\' else 1
+        elif char == '(':
+            if pattern.startswith('(?P=', i):
+                return False  # Named backreference.
+            groups.append(False)
+            i += 2 if pattern.startswith('(?', i) else 1
+            continue
+        elif char == ')' and len(groups) > 1:
+            inner = groups.pop()
+        elif char == '|':
+            groups[-1] = True
+        i += 1
+
+        # Check any quantifier on what came before.
+        quantifier = regex_quantifier.match(pattern, i)
+        if quantifier:
+            if inner and quantifier.group() not in ('{1}', '{0,1}'):
+                return False
+            repeats += quantifier.group(1) is not None
+            inner = True
+            i = quantifier.end()
+            if pattern[i:i + 1] in ('?', '+'):
+                i += 1  # Lazy or possessive.
+        groups[-1] = groups[-1] or inner
+
+    return repeats <= regex_max_repeats
+
+
+def get_list_arg(name):
+    """Return the comma-separated values of a querystring arg, over all its repeats, or None if not present."""
+
+    args = request.args.getlist(name)
+    if not args:
+        return None
+    return [value for arg in args for value in arg.split(',')]
+
+
+def find_rows(snapshot, conditions, start=0):
+    """
+    Yield positions (from start onwards) of rows matching all conditions (see get_conditions()), in file order.
+    Candidates come from the most selective index the conditions can use, or a full scan if none can.
+    """
+
+    candidates = plan_candidates(snapshot, conditions)
+    if candidates is None:
+        candidates = range(start, len(snapshot.rows))
+    elif start:
+        candidates = candidates[bisect_left(candidates, start):]
+
+    # Check every condition on each candidate.
+    checks = [make_check(*condition) for condition in conditions]
+    for i in candidates:
+        row = snapshot.rows[i]
+        if all(check(row) for check in checks):
+            yield i
+
+
+def plan_candidates(snapshot, conditions):
+    """
+    Return the positions, in file order, of the rows allowed by the most selective index lookup
+    the conditions can use, or None if none can. Plans are compared by how many rows they allow:
+    exact and in-list matches use the hash indexes, member matches the member index, ranges
+    (all bounds on a column together) and prefixes a sorted index of the column's values.
+    """
+
+    plans = []  # (row count, function returning the positions).
+    bounds = {}  # Maps int column to (lowest, highest) value allowed, None meaning unbounded.
+    for col, op, value in conditions:
+        if op == 'has' or op == 'has_any':
+            founds = [lookup(snapshot.member_index, member) for member in ([value] if op == 'has' else value)]
+            plans.append((sum(len(found) for found in founds), partial(merge_positions, founds)))
+        elif col not in snapshot.index:
+            continue
+        elif op == 'eq' or op == 'in':
+            founds = [lookup(snapshot.index[col], item) for item in ([value] if op == 'eq' else value)]
+            plans.append((sum(len(found) for found in founds), partial(merge_positions, founds)))
+        elif op == 'prefix':
+            col_sorted = sorted_index(snapshot, col, str)
+            i, j = col_sorted.prefix_slice(value)
+            plans.append((col_sorted.count(i, j), partial(col_sorted.positions_between, i, j)))
+        elif op in range_ops:
+            # Bounds are ints, so keep them all inclusive.
+            lower, upper = bounds.get(col, (None, None))
+            if op == 'gt' or op == 'gte':
+                value += op == 'gt'
+                lower = value if lower is None else max(lower, value)
+            else:
+                value -= op == 'lt'
+                upper = value if upper is None else min(upper, value)
+            bounds[col] = (lower, upper)
+    for col, (lower, upper) in bounds.items():
+        col_sorted = sorted_index(snapshot, col, int)
+        i, j = col_sorted.range_slice(lower, upper)
+        plans.append((col_sorted.count(i, j), partial(col_sorted.positions_between, i, j)))
+
+    if not plans:
+        return None
+    return min(plans, key=lambda plan: plan[0])[1]()
+
+
+def make_check(col, op, value):
+    """Return a function that tells whether a row matches one condition (see get_conditions())."""
+
+    get = operator.attrgetter(col)
+    if op == 'eq':
+        return lambda row: get(row) == value
+    if op == 'in':
+        return lambda row: get(row) in value
+    if op == 'prefix':
+        return lambda row: isinstance(get(row), str) and get(row).startswith(value)
+    if op == 'regex':
+        return lambda row: value.search(str(get(row))) is not None
+    if op == 'has':
+        return lambda row: value in row.members
+    if op == 'has_any':
+        return lambda row: not value.isdisjoint(row.members)
+    compare = range_ops[op]
+    return lambda row: isinstance(get(row), int) and compare(get(row), value)
+
+
+def merge_positions(founds):
+    """Return the union of sequences of row positions as a sorted sequence."""
+
+    if len(founds) == 1:
+        return founds[0]
+    return sorted(set().union(*founds))
+
+
+class SortedIndex:
+    """
+    The values of one type in an indexed column, in sorted order with their row positions,
+    for range and prefix lookups. Built from the column's index on first use, see sorted_index().
+    """
+
+    __slots__ = ['values', 'starts', 'positions']
+
+    def __init__(self, col_index, value_type):
+        items = sorted(((value, found) for value, found in col_index.items() if isinstance(value, value_type)),
+                       key=lambda item: item[0])
+        self.values = [value for value, _ in items]
+        self.starts = array('Q', [0])  # Offset of each value's positions in positions, plus one past the end.
+        self.positions = array('I')
+        for _, found in items:
+            self.positions.extend(expand_positions(found))
+            self.starts.append(len(self.positions))
+
+    def range_slice(self, lower, upper):
+        """Return (i, j) such that values[i:j] are between lower and upper inclusive; None means unbounded."""
+
+        i = 0 if lower is None else bisect_left(self.values, lower)
+        j = len(self.values) if upper is None else bisect_right(self.values, upper)
+        return i, max(i, j)
+
+    def prefix_slice(self, prefix):
+        """Return (i, j) such that values[i:j] are the values starting with prefix."""
+
+        i = j = bisect_left(self.values, prefix)
+        while j < len(self.values) and self.values[j].startswith(prefix):
+            j += 1
+        return i, j
+
+    def count(self, i, j):
+        """Return the number of rows with values[i:j]."""
+
+        return self.starts[j] - self.starts[i]
+
+    def positions_between(self, i, j):
+        """Return the positions of the rows with values[i:j], in file order."""
+
+        return sorted(self.positions[self.starts[i]:self.starts[j]])
+
+
+def sorted_index(snapshot, col, value_type):
+    """Return the SortedIndex of a snapshot's indexed column for values of value_type, building it on first use."""
+
+    key = (col, value_type)
+    col_sorted = snapshot.sorted_indexes.get(key)
+    if col_sorted is None:
+        col_sorted = snapshot.sorted_indexes[key] = SortedIndex(snapshot.index[col], value_type)
+    return col_sorted
+
+
+def wants_page():
+    """Return True if the request supplied any pagination args."""
+
+    return any(arg in request.args for arg in page_args)
+
+
+def list_response(snapshot, find, cols):
+    """
+    Return a list response of a snapshot's cached bodies, paged by any limit/offset/cursor args.
+    find(start) must yield matching row positions from position start onwards; cols are the output columns.
+    Sets the X-Next-Cursor header if more rows may follow the page.
+    """
+
+    positions, next_cursor = get_page(find, snapshot.file_time)
+    if time_stages and not wants_stream():
+        stage_start = time.perf_counter()
+        positions = list(positions)  # Run the lazy filter on its own to time it.
+        record_stage('query_filter', stage_start)
+        stage_start = time.perf_counter()
+        response = rows_response(snapshot, positions, cols)
+        record_stage('response_join', stage_start)
+    else:
+        response = rows_response(snapshot, positions, cols)
+    if next_cursor is not None:
+        response.headers['X-Next-Cursor'] = next_cursor
+
+    return response
+
+
+def rows_response(snapshot, positions, cols):
+    """
+    Return a response of the rows at positions, with output columns cols, in the negotiated wire format.
+    Users get a list of their groups too if the request asked for it, see expand_groups().
+    """
+
+    fmt = wire_format()
+    expand = expand_groups()
+    if expand is not None:
+        body = partial(expanded_user_body, snapshot, *expand)
+    else:
+        body = snapshot.body
+    if fmt == 'msgpack' and expand is None:
+        return Response(join_msgpack([msgpack_body(snapshot, i) for i in positions]), mimetype=msgpack_mimetype)
+    if fmt == 'columns':
+        positions = list(positions)
+        columns = columns_body([snapshot.rows[i] for i in positions], cols)
+        if expand is not None:
+            columns = columns[:-1] + b', "groups": ' + join_json(user_groups_body(snapshot, *expand, i)
+                                                                 for i in positions) + b'}'
+        return Response(columns, mimetype=columns_mimetype)
+    if wants_stream():
+        return stream_response(snapshot, positions, body)
+    return make_response(join_json(body(i) for i in positions))  # Packed in apply_headers() for MessagePack.
+
+
+def expand_groups():
+    """
+    Return (group snapshot, include primary groups) if the request asked for each user's groups with expand=groups
+    on a route in expand_rules, otherwise None. Abort with 400 for any other expand value.
+    """
+
+    expand = request.args.get('expand')
+    if expand is None or request.url_rule is None or route_rule() not in expand_rules:
+        return None
+    if expand != 'groups':
+        abort(400)
+
+    return read_groups(), wants_primary_group()
+
+
+def wants_primary_group():
+    """Return True if the request asked for users' primary groups (the group of their gid) with primary_group=1."""
+
+    return request.args.get('primary_group') == '1'
+
+
+def user_group_positions(groups, primary, user):
+    """
+    Return the positions, in file order, of the groups that list user as a member, from the member index,
+    plus the group of the user's gid if primary.
+    """
+
+    positions = lookup(groups.member_index, user.name)
+    if primary:
+        primary_positions = lookup(groups.index['gid'], user.gid)
+        if primary_positions:
+            positions = sorted(set(positions).union(primary_positions))
+
+    return positions
+
+
+def user_groups_body(users, groups, primary, i):
+    """Return the JSON list of the groups of the user at position i, see user_group_positions()."""
+
+    return join_json(groups.body(j) for j in user_group_positions(groups, primary, users.rows[i]))
+
+
+def expanded_user_body(users, groups, primary, i):
+    """Return the cached JSON body of the user at position i, with their groups added as "groups"."""
+
+    return users.body(i)[:-1] + b', "groups": ' + user_groups_body(users, groups, primary, i) + b'}'
+
+
+def cached_query(snapshot, kind, conditions, build):
+    """
+    Return the query response from the query result cache, or build() it and keep it there.
+    Results are keyed on the snapshot version, the conditions (a set, so argument order and repeats
+    don't matter), the page args, the wire format and any group expansion (with the group file version).
+    Streamed responses are never kept.
+    """
+
+    if query_cache_entries <= 0 or wants_stream():
+        return build()
+    kind = file_label(kind)
+    expand = expand_groups()
+    key = (kind, snapshot.version, frozenset(conditions), tuple(request.args.get(arg) for arg in page_args),
+           wire_format(), expand and (expand[0].version, expand[1]))
+    entry = query_cache.get(key)
+    count_metric(query_cache_lookups, (kind, 'miss' if entry is None else 'hit'))
+    if entry is not None:
+        body, mimetype, next_cursor = entry
+        response = Response(body, mimetype=mimetype)
+        if next_cursor is not None:
+            response.headers['X-Next-Cursor'] = next_cursor
+        return response
+
+    response = build()
+    query_cache.put(key, (response.get_data(), response.mimetype, response.headers.get('X-Next-Cursor')))
+    return response
+
+
+class QueryCache:
+    """
+    Least recently used cache of query results, bounded by entry count and total body size.
+    Keys start with the file kind and snapshot version, see cached_query(). Values are (body, mimetype, cursor).
+    """
+
+    def __init__(self):
+        self.entries = OrderedDict()  # Maps key to value, least recently used first.
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Return the value kept for key, or None."""
+
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        """Keep a value, evicting the least recently used ones past query_cache_entries or query_cache_bytes."""
+
+        size = len(value[0])
+        if size > query_cache_entry_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.bytes -= len(old[0])
+            self.entries[key] = value
+            self.bytes += size
+            while len(self.entries) > query_cache_entries or self.bytes > query_cache_bytes:
+                old_key, old = self.entries.popitem(last=False)
+                self.bytes -= len(old[0])
+                count_metric(query_cache_evictions, old_key[0])
+
+    def invalidate(self, kind, version):
+        """Drop the results for a file kind made from any snapshot version but version."""
+
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == kind and key[1] != version]:
+                self.bytes -= len(self.entries.pop(key)[0])
+
+
+def get_page(find, file_time):
+    """
+    Apply limit/offset/cursor args to the positions yielded by find(start).
+    Return (positions, next cursor or None).
+    Abort with 400 on invalid args, or 410 if the cursor was made from a different file version.
+    """
+
+    limit = get_int_arg('limit', 1)
+    offset = get_int_arg('offset', 0)
+    positions = find(cursor_start(file_time))
+    if offset is not None:
+        if isinstance(positions, range):
+            positions = positions[offset:]  # Constant time for plain listings.
+        else:
+            positions = islice(positions, offset, None)
+    if limit is None:
+        return positions, None
+
+    # Read one extra match to tell whether there is a next page.
+    page = list(islice(positions, limit + 1))
+    if len(page) <= limit:
+        return page, None
+    page = page[:limit]
+
+    return page, encode_cursor(page[-1], file_time)
+
+
+def cursor_start(file_time):
+    """
+    Return the position after the last one of the previous page, from the cursor arg, or 0 without one.
+    Abort with 400 if the cursor is invalid, or 410 if it was made from a different file version.
+    """
+
+    cursor = request.args.get('cursor')
+    if cursor is None:
+        return 0
+    last_position, cursor_time = decode_cursor(cursor)
+    if cursor_time != file_time:
+        abort(410)  # File changed since the cursor was issued, caller must restart.
+
+    return last_position + 1
+
+
+def get_int_arg(name, minimum):
+    """Return querystring arg as int, None if not present. Abort with 400 if invalid."""
+
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        value = int(value)
+    except ValueError:
+        abort(400)
+    if value < minimum:
+        abort(400)
+
+    return value
+
+
+def encode_cursor(last_position, file_time):
+    """Return an opaque cursor string for the row after last_position in the given file version."""
+
+    return base64.urlsafe_b64encode(dumps([last_position, file_time]).encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Return (last position, file time) from a cursor string. Abort with 400 if invalid."""
+
+    try:
+        last_position, file_time = loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError, binascii.Error):
+        abort(400)
+    if not isinstance(last_position, int) or last_position < -1:
+        abort(400)
+
+    return last_position, file_time
+
+
+def changes_response(changes, refresh):
+    """
+    Return the changes in a ChangeLog after the version in the since arg, as
+    {"version": current version, "added": [rows], "modified": [rows], "removed": [names]}.
+    With a wait arg, first wait up to that many seconds (at most changes_max_wait) for a new version.
+    Abort with 400 on invalid args, or 410 if the changes since that version are no longer logged.
+    """
+
+    since = get_int_arg('since', 0)
+    if since is None:
+        abort(400)
+    try:
+        wait = min(float(request.args.get('wait', 0)), changes_max_wait)
+    except ValueError:
+        abort(400)
+    if not wait >= 0:
+        abort(400)
+
+    # Long-poll until the file changes, checking it here unless the file watcher is running.
+    deadline = time.monotonic() + wait
+    while changes.version == since:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        if not watcher_running():
+            refresh(blocking=False)
+        changes.wait(since, min(remaining, watch_poll_interval))
+
+    version, merged = changes.since(since)
+    if merged is None:
+        abort(410)  # Caller must read the full listing and continue from its version.
+
+    rows = {'added': [], 'modified': [], 'removed': []}
+    for name, (kind, body) in merged.items():
+        rows[kind].append(body if body is not None else dumps(name).encode())
+
+    return join_json_object([('version', str(version).encode()), ('added', join_json(rows['added'])),
+                             ('modified', join_json(rows['modified'])), ('removed', join_json(rows['removed']))])
+
+
+def wants_stream():
+    """Return True if the request asked for a streamed response (?stream=1 or NDJSON Accept header)."""
+
+    return request.args.get('stream') == '1' or wants_ndjson()
+
+
+def wants_ndjson():
+    """Return True if the client prefers NDJSON over a JSON list."""
+
+    return wire_format() == 'ndjson'
+
+
+def wire_format():
+    """Return the response format the request's Accept header prefers, see choose_format()."""
+
+    if 'wire_format' not in g:
+        g.wire_format = choose_format(request.accept_mimetypes, route_rule())
+    return g.wire_format
+
+
+def choose_format(accept_mimetypes, rule):
+    """
+    Return the response format a parsed Accept header prefers for a route rule: 'json', or 'ndjson'
+    and 'columns' for routes returning rows, or 'msgpack' if installed. JSON wins ties.
+    """
+
+    offered = ['application/json']
+    if rule in list_rules:
+        offered += [ndjson_mimetype, columns_mimetype]
+    if msgpack is not None and rule in msgpack_rules:
+        offered.append(msgpack_mimetype)
+
+    return {ndjson_mimetype: 'ndjson', columns_mimetype: 'columns',
+            msgpack_mimetype: 'msgpack'}.get(accept_mimetypes.best_match(offered), 'json')
+
+
+def format_body(snapshot, position, fmt, cols=None):
+    """
+    Return a snapshot's listing (position None, with output columns cols) or the row at position in a wire format:
+    'json', 'msgpack', or 'columns' (listings only). Listings in formats other than JSON are made on first use
+    and kept with the snapshot.
+    """
+
+    if fmt == 'json':
+        return snapshot.all_body if position is None else snapshot.body(position)
+    if position is not None:
+        return msgpack_body(snapshot, position)
+    body = snapshot.format_bodies.get(fmt)
+    if body is None:
+        if fmt == 'msgpack':
+            body = join_msgpack([msgpack_body(snapshot, i) for i in range(len(snapshot.rows))])
+        else:
+            body = columns_body(snapshot.rows, cols)
+        snapshot.format_bodies[fmt] = body
+
+    return body
+
+
+def msgpack_body(snapshot, i):
+    """Return the MessagePack body of a snapshot's row at position i, packing it on first use."""
+
+    bodies = snapshot.format_bodies.get('msgpack_rows')
+    if bodies is None:
+        bodies = snapshot.format_bodies.setdefault('msgpack_rows', [None] * len(snapshot.rows))
+    body = bodies[i]
+    if body is None:
+        body = bodies[i] = msgpack.packb(snapshot.rows[i].to_json())
+
+    return body
+
+
+def join_msgpack(bodies):
+    """Join a list of packed MessagePack bodies into a MessagePack array."""
+
+    count = len(bodies)
+    if count < 16:
+        header = bytes([0x90 | count])
+    elif count < 0x10000:
+        header = b'\xdc' + count.to_bytes(2, 'big')
+    else:
+        header = b'\xdd' + count.to_bytes(4, 'big')
+
+    return header + b''.join(bodies)
+
+
+def columns_body(rows, cols):
+    """Return rows as a columnar JSON object, {column: [value of each row]}, for output columns cols."""
+
+    return dumps({col: [getattr(row, col) for row in rows] for col in cols}).encode()
+
+
+def pack_response(response):
+    """Convert a JSON response built without cached MessagePack bodies to MessagePack."""
+
+    response.set_data(msgpack.packb(loads(response.get_data())))
+    response.mimetype = msgpack_mimetype
+
+
+def stream_response(snapshot, positions=None, body=None):
+    """
+    Return a response that streams cached JSON bodies (or body(i) for each position, if given) in chunks.
+    Sends NDJSON if the client accepts it, otherwise a JSON list.
+    Holds a reference to the given snapshot, so a reload mid-stream does not mix file versions.
+    """
+
+    if positions is None:
+        positions = range(len(snapshot.rows))
+    if body is None:
+        body = snapshot.body
+
+    def generate_chunks():
+        chunk = []
+        for i in positions:
+            chunk.append(body(i))
+            if len(chunk) == stream_chunk_rows:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    if wants_ndjson():
+        def generate():
+            for chunk in generate_chunks():
+                yield b'\n'.join(chunk) + b'\n'
+
+        return Response(generate(), mimetype=ndjson_mimetype)
+
+    def generate():
+        yield b'['
+        first = True
+        for chunk in generate_chunks():
+            if not first:
+                yield b', '
+            first = False
+            yield b', '.join(chunk)
+        yield b']'
+
+    return Response(generate(), mimetype='application/json')
+
+
+class AdmissionLimiter:
+    """
+    Bounded concurrency limiter, in cost units up to admission_capacity. Waiting requests are admitted
+    in arrival order, so a cheap request can't overtake an expensive one and starve it.
+    """
+
+    def __init__(self):
+        self.in_use = 0
+        self.queue = deque()  # Tickets of waiting requests, first come first served.
+        self.condition = threading.Condition()
+
+    def acquire(self, cost):
+        """
+        Wait up to admission_timeout seconds for room for cost (capped at admission_capacity) and take it.
+        Return the cost taken, to pass to release(), or 0 if the queue was full or the wait timed out.
+        """
+
+        cost = min(cost, admission_capacity)
+        with self.condition:
+            if not self.queue and self.in_use + cost <= admission_capacity:
+                self.in_use += cost
+                return cost
+            if len(self.queue) >= admission_queue_length:
+                return 0
+
+            ticket = object()
+            self.queue.append(ticket)
+            deadline = time.monotonic() + admission_timeout
+            try:
+                while self.queue[0] is not ticket or self.in_use + cost > admission_capacity:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return 0
+                    self.condition.wait(remaining)
+                self.in_use += cost
+                return cost
+            finally:
+                self.queue.remove(ticket)
+                self.condition.notify_all()  # Let the next in line check for room.
+
+    def release(self, cost):
+        """Give back cost taken by acquire()."""
+
+        with self.condition:
+            self.in_use -= cost
+            self.condition.notify_all()
+
+
+class Histogram:
+    """Cumulative latency histogram over latency_buckets, in seconds."""
+
+    __slots__ = ['counts', 'sum', 'count']
+
+    def __init__(self):
+        self.counts = [0] * len(latency_buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        """Add one observation; caller holds metrics_lock."""
+
+        for i, bound in enumerate(latency_buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+def count_metric(counts, key):
+    """Add one to a counter dict."""
+
+    with metrics_lock:
+        counts[key] = counts.get(key, 0) + 1
+
+
+def observe_metric(histograms, key, value):
+    """Add one observation to a dict of Histograms."""
+
+    with metrics_lock:
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = Histogram()
+        histogram.observe(value)
+
+
+def record_stage(stage, start):
+    """Record time since start for a stage. Only call when time_stages is True."""
+
+    observe_metric(stage_latency, stage, time.perf_counter() - start)
+
+
+def record_request(response):
+    """Count the request and record its latency (up to the response being built, not sent)."""
+
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    record_route(route, request.method, response.status_code, g.get('request_start'))
+
+
+def record_route(route, method, status, start=None):
+    """Count a request to a route and, given the perf_counter() time it started, record its latency."""
+
+    count_metric(request_counts, (route, method, str(status)))
+    if start is not None:
+        observe_metric(request_latency, route, time.perf_counter() - start)
+
+
+def format_metrics():
+    """Return all metrics in Prometheus text format."""
+
+    lines = []
+
+    def add_counter(name, help_text, counts, label_names):
+        lines.append('# HELP {0} {1}'.format(name, help_text))
+        lines.append('# TYPE {0} counter'.format(name))
+        for key, value in sorted(counts.items()):
+            key = key if isinstance(key, tuple) else (key,)
+            lines.append('{0}{1} {2}'.format(name, format_labels(zip(label_names, key)), value))
+
+    def add_histogram(name, help_text, histograms, label_name):
+        lines.append('# HELP {0} {1}'.format(name, help_text))
+        lines.append('# TYPE {0} histogram'.format(name))
+        for key, histogram in sorted(histograms.items()):
+            for bound, count in zip(latency_buckets, histogram.counts):
+                labels = format_labels([(label_name, key), ('le', repr(bound))])
+                lines.append('{0}_bucket{1} {2}'.format(name, labels, count))
+            labels = format_labels([(label_name, key), ('le', '+Inf')])
+            lines.append('{0}_bucket{1} {2}'.format(name, labels, histogram.count))
+            labels = format_labels([(label_name, key)])
+            lines.append('{0}_sum{1} {2!r}'.format(name, labels, histogram.sum))
+            lines.append('{0}_count{1} {2}'.format(name, labels, histogram.count))
+
+    with metrics_lock:
+        add_counter('paas_requests_total', 'Requests handled, by route, method and status.',
+                    request_counts, ['route', 'method', 'status'])
+        add_histogram('paas_request_duration_seconds', 'Time to build each response, by route.',
+                      request_latency, 'route')
+        add_counter('paas_file_checks_total', 'File modify time checks, by file and result.',
+                    file_checks, ['file', 'result'])
+        add_counter('paas_reload_failures_total', 'File reads that failed, by file.',
+                    reload_failures, ['file'])
+        add_histogram('paas_reload_duration_seconds', 'Time to check, read and publish a changed file.',
+                      reload_latency, 'file')
+        add_histogram('paas_stage_duration_seconds', 'Time spent in each stage, if time_stages is set.',
+                      stage_latency, 'stage')
+        add_counter('paas_query_cache_lookups_total', 'Query result cache lookups, by file and result.',
+                    query_cache_lookups, ['file', 'result'])
+        add_counter('paas_query_cache_evictions_total', 'Query results evicted to make room, by file.',
+                    query_cache_evictions, ['file'])
+        add_histogram('paas_admission_wait_seconds', 'Time waited for admission, by route.',
+                      admission_waits, 'route')
+        add_counter('paas_admission_shed_total', 'Requests shed with 503 by admission control, by route.',
+                    admission_shed, ['route'])
+
+    # Row counts come straight from the current snapshots.
+    lines.append('# HELP paas_rows Rows in the current snapshot, by file.')
+    lines.append('# TYPE paas_rows gauge')
+    files = [('groups', group_snapshot), ('users', user_snapshot)]
+    files.extend(sorted((source.label(kind), snapshot) for source in list(sources.values())
+                        for kind, snapshot in source.snapshots.items()))
+    for name, snapshot in files:
+        lines.append('paas_rows{0} {1}'.format(format_labels([('file', name)]), len(snapshot.rows)))
+    lines.append('# HELP paas_query_cache_entries Query results in the cache.')
+    lines.append('# TYPE paas_query_cache_entries gauge')
+    lines.append('paas_query_cache_entries {0}'.format(len(query_cache.entries)))
+    lines.append('# HELP paas_query_cache_bytes Bytes of query result bodies in the cache.')
+    lines.append('# TYPE paas_query_cache_bytes gauge')
+    lines.append('paas_query_cache_bytes {0}'.format(query_cache.bytes))
+    lines.append('# HELP paas_admission_queue_depth Requests waiting for admission.')
+    lines.append('# TYPE paas_admission_queue_depth gauge')
+    lines.append('paas_admission_queue_depth {0}'.format(len(admission_limiter.queue)))
+    lines.append('# HELP paas_admission_in_use Cost units of admitted requests still running.')
+    lines.append('# TYPE paas_admission_in_use gauge')
+    lines.append('paas_admission_in_use {0}'.format(admission_limiter.in_use))
+
+    return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    """Return Prometheus label text, e.g. {route="/users"}."""
+
+    parts = []
+    for name, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        parts.append('{0}="{1}"'.format(name, value))
+
+    return '{' + ','.join(parts) + '}'
+
+
+class ProfileSampler(threading.Thread):
+    """
+    Background thread that samples another thread's Python stack every interval seconds until stopped,
+    counting each distinct stack (outermost frame first).
+    """
+
+    def __init__(self, thread_id, interval):
+        super().__init__(name='profile-sampler', daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.stacks = {}  # Maps tuple of frame names to sample count.
+        self.start_time = time.perf_counter()
+        self.duration = None
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('{0}:{1}'.format(os.path.basename(code.co_filename), code.co_name))
+                frame = frame.f_back
+            if stack:
+                stack = tuple(reversed(stack))
+                self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+    def stop(self):
+        """Stop the thread and wait for it to exit."""
+
+        if self.duration is None:
+            self.duration = time.perf_counter() - self.start_time
+            self.stop_event.set()
+            self.join()
+
+
+def finish_profile(response):
+    """Stop sampling the request, keep its profile in the ring buffer and name it in an X-Profile-Id header."""
+
+    g.profiler.stop()
+    profile = {'time': time.time(), 'method': request.method,
+               'path': request.full_path.rstrip('?'), 'status': response.status_code,
+               'duration': g.profiler.duration, 'stacks': g.profiler.stacks}
+    with profiles_lock:
+        profile['id'] = next(profile_ids)
+        profiles.append(profile)
+    response.headers['X-Profile-Id'] = str(profile['id'])
+
+
+def profile_summary(profile):
+    """
+    Return a profile without its stacks, plus its sample count and the samples in (not only directly in)
+    each of profile_functions.
+    """
+
+    functions = dict.fromkeys(profile_functions, 0)
+    for stack, count in profile['stacks'].items():
+        for function in set(frame.rsplit(':', 1)[1] for frame in stack) & functions.keys():
+            functions[function] += count
+
+    summary = {key: value for key, value in profile.items() if key != 'stacks'}
+    summary['samples'] = sum(profile['stacks'].values())
+    summary['functions'] = functions
+    return summary
+
+
+def check_profile_token():
+    """Abort with 404 if profiling is off, or 403 unless the X-Profile header has the admin token."""
+
+    if profile_token is None:
+        abort(404)
+    if not hmac.compare_digest(request.headers.get('X-Profile', '').encode(), profile_token.encode()):
+        abort(403)
+
+
+def get_batch_args(arg_cols):
+    """
+    Return {arg: [keys]} from the JSON request body, for the args in arg_cols (mapping arg to column).
+    Keys for uid/gid columns are converted to int, others to str, and repeats dropped after converting.
+    Other args are ignored, like unsupported querystring args. Abort with 400 if the body or a list is invalid
+    (keys must be strings or integers, not booleans), or 413 if there are more than batch_limit keys.
+    """
+
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        abort(400)
+
+    batch = {}
+    for arg, col in arg_cols.items():
+        if arg not in body:
+            continue
+        keys = body[arg]
+        if not isinstance(keys, list) or not all(isinstance(key, (str, int)) for key in keys):
+            abort(400)
+        if any(isinstance(key, bool) for key in keys):
+            abort(400)  # JSON true and false would otherwise look up 1 and 0.
+        if col in ['uid', 'gid']:
+            keys = [convert_to_int(key) for key in keys]
+        else:
+            keys = [str(key) for key in keys]
+        batch[arg] = list(dict.fromkeys(keys))  # Each key once, so the object has no duplicate keys.
+    if sum(len(keys) for keys in batch.values()) > batch_limit:
+        abort(413)
+
+    return batch
+
+
+def first_body(snapshot, col, key):
+    """Return the cached JSON body of the first row with key in an indexed column, or null."""
+
+    found = lookup(snapshot.index[col], key)
+    return snapshot.body(found[0]) if found else b'null'
+
+
+def member_groups_body(groups, users, uid):
+    """Return the JSON list of groups that the user with uid is a member of, or null if there is no such user."""
+
+    found = lookup(users.index['uid'], uid)
+    if not found:
+        return b'null'
+    return join_json(groups.body(i) for i in lookup(groups.member_index, users.rows[found[0]].name))
+
+
+def join_json_object(items):
+    """Join (key, serialized JSON body) pairs into a JSON object, matching dumps() separators."""
+
+    return b'{' + b', '.join(dumps(str(key)).encode() + b': ' + body for key, body in items) + b'}'
+
+
+def join_json(bodies):
+    """Join serialized JSON bodies into a JSON list, matching dumps() separators."""
+
+    return b'[' + b', '.join(bodies) + b']'
+
+
+def convert_to_int(s):
+    """Convert any object to int if possible, otherwise return original object."""
+
+    try:
+        return int(s)
+    except (ValueError, TypeError):
+        return s
+
+
+# Serve each source's files with the same routes, see pull_source().
+for rule in list(app.url_map.iter_rules()):
+    if rule.endpoint != 'static' and rule.rule not in unsourced_rules:
+        app.add_url_rule(source_prefix + rule.rule, rule.endpoint, methods=rule.methods)
+
+# Set global snapshots, replaced as a whole on each file reload, and their change logs.
+user_snapshot = Snapshot()
+group_snapshot = Snapshot()
+user_changes = ChangeLog()
+group_changes = ChangeLog()
+query_cache = QueryCache()
+admission_limiter = AdmissionLimiter()
 
 
 if __name__ == '__main__':
+    if watch_files:
+        start_watcher()
     if __debug__:
         app.run(debug=True)
     else:
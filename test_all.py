@@ -8,12 +8,35 @@ validates that the data was returned in the correct format, edge cases, etc.
 
 import sys
 import os
+import shutil
+import tempfile
+import time
+import threading
+import io
+import subprocess
+import http.client
 from flask import Flask, request
+from flask.testing import FlaskClient
 import unittest
 import json
+import gzip
+import re
+import asyncio
 from itertools import combinations
+import service
+import asgi
+import benchmark
 from service import app
 
+class ClosingClient(FlaskClient):
+    # Test client that reads and closes each response like a WSGI server, unless buffered=False is passed.
+
+    def open(self, *args, buffered=True, **kwargs):
+        return super().open(*args, buffered=buffered, **kwargs)
+
+
+app.test_client_class = ClosingClient
+
 # Adjust these to test with other user/group.
 dummy_user = 0
 dummy_group = 0
@@ -91,6 +114,16 @@ class TestService(unittest.TestCase):
             # Check for all user columns in returned data.
             self.valid_user_data(json_vals, True)
 
+    def test_users_cached_json(self):
+        # Check cached single user bodies against the cached listing.
+
+        self.test_app = app.test_client()
+        users = json.loads(self.test_app.get('/users').data)
+        for user in users:
+            response = self.test_app.get('/users/' + str(user['uid']))
+            first_user = next(u for u in users if u['uid'] == user['uid'])
+            self.assertEqual(json.loads(response.data), first_user)
+
     def test_users_query(self):
         # Test users query status code.
 
@@ -177,6 +210,18 @@ class TestService(unittest.TestCase):
             # Check for all user columns in returned data.
             self.valid_user_data(json_vals, False)
 
+    def test_users_query_matches_scan(self):
+        # Check indexed and scanned query results against a filter of all users.
+
+        self.test_app = app.test_client()
+        users = json.loads(self.test_app.get('/users').data)
+        for user in users:
+            for item in [{'uid': user['uid']}, {'shell': user['shell']},
+                         {'name': user['name'], 'home': user['home']}]:
+                response = self.test_app.get('/users/query', query_string=item)
+                expected = [u for u in users if all(str(u[k]) == str(v) for k, v in item.items())]
+                self.assertEqual(json.loads(response.data), expected)
+
     def test_users_groups(self):
         # Test user group status code.
 
@@ -211,6 +256,53 @@ class TestService(unittest.TestCase):
             # Check for all group columns in returned data.
             self.valid_group_data(json_vals, False)
 
+    def test_users_groups_index(self):
+        # Check indexed user group lookup against a scan of all groups.
+
+        self.test_app = app.test_client()
+        users = json.loads(self.test_app.get('/users').data)
+        groups = json.loads(self.test_app.get('/groups').data)
+        for user in users:
+            response = self.test_app.get('/users/' + str(user['uid']) + '/groups')
+            self.assertEqual(response.status_code, 200)
+            if user is not next(u for u in users if u['uid'] == user['uid']):
+                continue  # Duplicate uid, first user in file wins.
+            expected = [group for group in groups if user['name'] in group['members']]
+            self.assertEqual(json.loads(response.data), expected)
+
+    def test_users_expand_groups(self):
+        # Check expand=groups against a scan of all groups, with and without primary groups.
+
+        self.test_app = app.test_client()
+        users = json.loads(self.test_app.get('/users').data)
+        groups = json.loads(self.test_app.get('/groups').data)
+        for primary in [False, True]:
+            args = {'expand': 'groups', 'primary_group': '1' if primary else '0'}
+            expected = [dict(user, groups=self.user_groups(user, groups, primary)) for user in users]
+            self.assertEqual(json.loads(self.test_app.get('/users', query_string=args).data), expected)
+            response = self.test_app.get('/users', query_string=dict(args, limit=2))
+            self.assertEqual(json.loads(response.data), expected[:2])
+            response = self.test_app.get('/users', query_string=args, headers={'Accept': 'application/x-ndjson'})
+            self.assertEqual([json.loads(line) for line in response.data.splitlines()], expected)
+            response = self.test_app.get('/users/query', query_string=dict(args, uid_lt=1000))
+            self.assertEqual(json.loads(response.data), [user for user in expected if user['uid'] < 1000])
+            response = self.test_app.get('/users/0', query_string=args)
+            self.assertEqual(json.loads(response.data), next(user for user in expected if user['uid'] == 0))
+            response = self.test_app.get('/users/0/groups', query_string={'primary_group': args['primary_group']})
+            self.assertEqual(json.loads(response.data), expected[[u['uid'] for u in users].index(0)]['groups'])
+
+            # Columns get a list of groups per user.
+            response = self.test_app.get('/users', query_string=args,
+                                         headers={'Accept': 'application/vnd.paas.columns+json'})
+            self.assertEqual(json.loads(response.data)['groups'], [user['groups'] for user in expected])
+
+        # Expansion depends on the group file too, so it changes the ETag.
+        self.assertNotEqual(self.test_app.get('/users/0').headers['ETag'],
+                            self.test_app.get('/users/0?expand=groups').headers['ETag'])
+        self.assertIn('X-Groups-Version', self.test_app.get('/users/0?expand=groups').headers)
+        self.assertEqual(self.test_app.get('/users?expand=members').status_code, 400)
+        self.assertNotIn('groups', json.loads(self.test_app.get('/groups/0?expand=groups').data))
+
     def test_groups_all(self):
         # Test all groups status code.
 
@@ -359,8 +451,607 @@ class TestService(unittest.TestCase):
             # Check for all groups columns in returned data.
             self.valid_group_data(json_vals, False)
 
+    def test_groups_query_matches_scan(self):
+        # Check indexed group query results against a filter of all groups.
+
+        self.test_app = app.test_client()
+        groups = json.loads(self.test_app.get('/groups').data)
+        for group in groups:
+            for item in [{'gid': group['gid']}, {'member': group['members']},
+                         {'name': group['name'], 'member': group['members'][:1]}]:
+                response = self.test_app.get('/groups/query', query_string=item)
+                expected = [g for g in groups
+                            if all(str(g[k]) == str(v) for k, v in item.items() if k != 'member')
+                            and all(m in g['members'] for m in item.get('member', []))]
+                self.assertEqual(json.loads(response.data), expected)
+
+    def test_users_query_operators(self):
+        # Check range, in-list, prefix and regex queries against a filter of all users.
+
+        self.test_app = app.test_client()
+        users = json.loads(self.test_app.get('/users').data)
+        uids = sorted(u['uid'] for u in users)
+        middle = uids[len(uids) // 2]
+        shells = sorted(set(u['shell'] for u in users))
+        queries = [
+            ({'uid_gte': middle}, lambda u: u['uid'] >= middle),
+            ({'uid_gt': middle}, lambda u: u['uid'] > middle),
+            ({'uid_lt': middle, 'gid_gte': 1}, lambda u: u['uid'] < middle and u['gid'] >= 1),
+            ({'uid_gte': middle, 'uid_lte': middle}, lambda u: u['uid'] == middle),
+            ({'uid_gt': 10, 'uid_gte': 5, 'uid_lt': 100000}, lambda u: 10 < u['uid'] < 100000),
+            ({'uid_in': '{0},{1}'.format(uids[0], uids[-1])}, lambda u: u['uid'] in [uids[0], uids[-1]]),
+            ({'shell_in': shells[:2]}, lambda u: u['shell'] in shells[:2]),
+            ({'name_prefix': users[0]['name'][:2]}, lambda u: u['name'].startswith(users[0]['name'][:2])),
+            ({'home_prefix': '/'}, lambda u: u['home'].startswith('/')),
+            ({'name_regex': 'o.t$'}, lambda u: re.search('o.t$', u['name'])),
+            ({'uid_regex': '^1', 'name_prefix': ''}, lambda u: str(u['uid']).startswith('1')),
+            ({'name_prefix': 'no such user'}, lambda u: False),
+        ]
+        for item, check in queries:
+            response = self.test_app.get('/users/query', query_string=item)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(json.loads(response.data), [u for u in users if check(u)], item)
+
+        # Invalid range bounds, prefixes on int columns and regexes.
+        for item in [{'uid_gt': 'x'}, {'gid_lte': '1.5'}, {'uid_prefix': '1'}, {'gid_prefix': '1'}, {'name_regex': '('},
+                     {'name_regex': 'a' * (service.regex_max_length + 1)}]:
+            self.assertEqual(self.test_app.get('/users/query', query_string=item).status_code, 400)
+
+        # Range operators only apply to int columns.
+        response = self.test_app.get('/users/query', query_string={'name_gt': 'a'})
+        self.assertEqual(json.loads(response.data), users)
+
+    def test_users_query_regex_backtracking(self):
+        # Check that patterns with exponential backtracking run in linear time with re2, and are refused without it.
+
+        self.test_app = app.test_client()
+        self.addCleanup(setattr, service, 'query_cache_entries', service.query_cache_entries)
+        service.query_cache_entries = 0
+        pathological = [{'comment_regex': '(.*)*x'}, {'home_regex': '(a|a)+$'}, {'name_regex': '(\\w+\\s?)*!'},
+                        {'home_regex': '(.|.){22}#'}, {'home_regex': '(?:.|.){22}#'},
+                        {'home_regex': '(.?){25}.{25}#'}, {'home_regex': '.?' * 25 + '.{25}#'}]
+        if service.re2 is not None:
+            for item in pathological:
+                start = time.perf_counter()
+                response = self.test_app.get('/users/query', query_string=item)
+                self.assertEqual(response.status_code, 200, item)
+                self.assertLess(time.perf_counter() - start, 1.0, item)
+
+        self.addCleanup(setattr, service, 're2', service.re2)
+        service.re2 = None
+        for item in pathological + [{'comment_regex': '.*.*x'}, {'name_regex': '(a)\\1'}]:
+            self.assertEqual(self.test_app.get('/users/query', query_string=item).status_code, 400, item)
+        response = self.test_app.get('/users/query', query_string={'name_regex': '^r(oo)?t$'})
+        self.assertEqual(response.status_code, 200)
+
+    def test_groups_query_operators(self):
+        # Check any-member, range and prefix queries against a filter of all groups.
+
+        self.test_app = app.test_client()
+        groups = json.loads(self.test_app.get('/groups').data)
+        members = sorted(set(m for g in groups for m in g['members']))
+        some = members[:2] or ['root', 'nobody']  # Group files may have no members.
+        gids = sorted(g['gid'] for g in groups)
+        middle = gids[len(gids) // 2]
+        queries = [
+            ({'member_any': ','.join(some)}, lambda g: any(m in g['members'] for m in some)),
+            ({'member_any': some}, lambda g: any(m in g['members'] for m in some)),
+            ({'member_any': some, 'member': some[:1]}, lambda g: some[0] in g['members']),
+            ({'gid_lt': middle}, lambda g: g['gid'] < middle),
+            ({'gid_gte': middle, 'member_any': some}, lambda g: g['gid'] >= middle
+             and any(m in g['members'] for m in some)),
+            ({'name_prefix': groups[-1]['name'][:1]}, lambda g: g['name'].startswith(groups[-1]['name'][:1])),
+            ({'gid_in': [gids[0], gids[-1]]}, lambda g: g['gid'] in [gids[0], gids[-1]]),
+        ]
+        for item, check in queries:
+            response = self.test_app.get('/groups/query', query_string=item)
+            self.assertEqual(json.loads(response.data), [g for g in groups if check(g)], item)
+
+    def test_compressed_responses(self):
+        # Check that listings are compressed as negotiated, once per snapshot.
+
+        self.addCleanup(setattr, service, 'compress_min_size', service.compress_min_size)
+        service.compress_min_size = 0  # The test files may be small.
+        self.test_app = app.test_client()
+        plain = self.test_app.get('/users')
+        self.assertNotIn('Content-Encoding', plain.headers)
+        self.assertIn('Accept-Encoding', plain.headers['Vary'])
+        encodings = ['gzip'] + (['br'] if service.brotli is not None else [])
+        for encoding in encodings:
+            response = self.test_app.get('/users', headers={'Accept-Encoding': encoding})
+            self.assertEqual(response.headers['Content-Encoding'], encoding)
+            self.assertEqual(self.decompress(encoding, response.data), plain.data)
+            self.assertNotEqual(response.headers['ETag'], plain.headers['ETag'])
+            response = self.test_app.get('/users', headers={'Accept-Encoding': encoding,
+                                                            'If-None-Match': response.headers['ETag']})
+            self.assertEqual(response.status_code, 304)
+        users = service.user_snapshot
+        self.assertIs(service.encoded_body(users, None, 'gzip')[0], service.encoded_body(users, None, 'gzip')[0])
+
+        # Preferences, refusals and uncompressed routes.
+        self.assertEqual(service.choose_encoding('gzip;q=0.5, br'), 'br' if service.brotli is not None else 'gzip')
+        self.assertEqual(service.choose_encoding('*'), service.content_encodings[0])
+        for accept_encoding in ['', 'identity', 'gzip;q=0', 'deflate']:
+            self.assertEqual(service.choose_encoding(accept_encoding), '')
+            response = self.test_app.get('/users', headers={'Accept-Encoding': accept_encoding})
+            self.assertEqual(response.data, plain.data)
+        for path in ['/users?stream=1', '/users?limit=100', '/users/query', '/users/0/groups', '/metrics']:
+            response = self.test_app.get(path, headers={'Accept-Encoding': 'gzip'})
+            self.assertNotIn('Content-Encoding', response.headers, path)
+
+        # Bodies under compress_min_size are sent as they are.
+        plain = self.test_app.get('/users/' + str(dummy_user))
+        service.compress_min_size = len(plain.data) + 1
+        response = self.test_app.get('/users/' + str(dummy_user), headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(response.data, plain.data)
+
+    def test_wire_formats(self):
+        # Check MessagePack and columnar responses against the JSON ones.
+
+        self.test_app = app.test_client()
+        columns = {'Accept': service.columns_mimetype}
+        for path, cols in [('/users', user_cols), ('/users?limit=3', user_cols), ('/users/query?uid_lt=100', user_cols),
+                           ('/users/0/groups', group_cols_output), ('/groups', group_cols_output),
+                           ('/groups/query?gid_gte=1', group_cols_output)]:
+            rows = json.loads(self.test_app.get(path).data)
+            response = self.test_app.get(path, headers=columns)
+            self.assertEqual(response.mimetype, service.columns_mimetype)
+            self.assertEqual(json.loads(response.data), {col: [row[col] for row in rows] for col in cols}, path)
+            if service.msgpack is not None:
+                response = self.test_app.get(path, headers={'Accept': service.msgpack_mimetype})
+                self.assertEqual(response.mimetype, service.msgpack_mimetype)
+                self.assertEqual(service.msgpack.unpackb(response.data), rows, path)
+
+        # Pages keep their cursors, and each format has its own ETag.
+        plain = self.test_app.get('/users?limit=1')
+        response = self.test_app.get('/users?limit=1', headers=columns)
+        self.assertEqual(response.headers['X-Next-Cursor'], plain.headers['X-Next-Cursor'])
+        self.assertNotEqual(response.headers['ETag'], plain.headers['ETag'])
+
+        # Single rows and other routes have no columnar form, and JSON is the default.
+        plain = self.test_app.get('/users/' + str(dummy_user))
+        self.assertEqual(self.test_app.get('/users/' + str(dummy_user), headers=columns).data, plain.data)
+        self.assertEqual(self.test_app.get('/users', headers={'Accept': '*/*'}).mimetype, 'application/json')
+        if service.msgpack is not None:
+            packed = self.test_app.get('/users/' + str(dummy_user), headers={'Accept': service.msgpack_mimetype})
+            self.assertEqual(service.msgpack.unpackb(packed.data), json.loads(plain.data))
+            batch = {'uids': [dummy_user, 1000000]}
+            plain = self.test_app.post('/users/batch', json=batch)
+            packed = self.test_app.post('/users/batch', json=batch, headers={'Accept': service.msgpack_mimetype})
+            self.assertEqual(service.msgpack.unpackb(packed.data), json.loads(plain.data))
+            self.assertEqual(self.test_app.get('/metrics', headers={'Accept': service.msgpack_mimetype}).mimetype,
+                             'text/plain')
+
+        # Arrays of every header size.
+        if service.msgpack is not None:
+            for count in [0, 15, 16, 65535, 65536]:
+                bodies = [service.msgpack.packb(i) for i in range(count)]
+                self.assertEqual(service.msgpack.unpackb(service.join_msgpack(bodies)), list(range(count)))
+
+    def test_query_cache(self):
+        # Check that equivalent queries share one cached result, and that the cache stays in bounds.
+
+        self.test_app = app.test_client()
+        service.query_cache = service.QueryCache()
+        self.addCleanup(setattr, service, 'query_cache_entries', service.query_cache_entries)
+        self.addCleanup(setattr, service, 'query_cache_bytes', service.query_cache_bytes)
+        groups = json.loads(self.test_app.get('/groups').data)
+        members = sorted(set(m for g in groups for m in g['members'])) or ['root', 'nobody']
+        hits = self.metric_value('paas_query_cache_lookups_total{file="groups",result="hit"}')
+        misses = self.metric_value('paas_query_cache_lookups_total{file="groups",result="miss"}')
+        first = self.test_app.get('/groups/query?member={0}&member={1}&gid_gte=0'.format(*members[:2]))
+        for query in ['member={1}&member={0}&gid_gte=0', 'gid_gte=00&member={1}&member={0}&member={1}',
+                      'member={0}&gid_gte=0&member={1}&asdf=1']:
+            response = self.test_app.get('/groups/query?' + query.format(*members[:2]))
+            self.assertEqual(response.data, first.data)
+        self.assertEqual(self.metric_value('paas_query_cache_lookups_total{file="groups",result="hit"}'), hits + 3)
+        self.assertEqual(self.metric_value('paas_query_cache_lookups_total{file="groups",result="miss"}'), misses + 1)
+
+        # Pages keep their cursors, and other formats and streams get their own results.
+        first = self.test_app.get('/users/query?gid_gte=0&limit=1')
+        response = self.test_app.get('/users/query?gid_gte=0&limit=1')
+        self.assertEqual(response.headers['X-Next-Cursor'], first.headers['X-Next-Cursor'])
+        self.assertEqual(response.data, first.data)
+        response = self.test_app.get('/users/query?gid_gte=0&limit=1', headers={'Accept': service.columns_mimetype})
+        self.assertEqual(response.mimetype, service.columns_mimetype)
+        entries = len(service.query_cache.entries)
+        self.test_app.get('/users/query?gid_gte=0&stream=1')
+        self.assertEqual(len(service.query_cache.entries), entries)
+
+        # Least recently used results are evicted past the entry and byte limits.
+        service.query_cache_entries = 2
+        for uid in range(3):
+            self.test_app.get('/users/query', query_string={'uid': uid})
+        self.assertEqual(len(service.query_cache.entries), 2)
+        self.assertEqual([key[2] for key in service.query_cache.entries],
+                         [frozenset([('uid', 'eq', 1)]), frozenset([('uid', 'eq', 2)])])
+        service.query_cache_bytes = service.query_cache.bytes
+        self.test_app.get('/users/query', query_string={'uid': 1})  # Now most recently used.
+        self.test_app.get('/users/query', query_string={'uid': 3})
+        conditions = [key[2] for key in service.query_cache.entries]
+        self.assertNotIn(frozenset([('uid', 'eq', 2)]), conditions)
+        self.assertEqual(conditions[-1], frozenset([('uid', 'eq', 3)]))
+        self.assertLessEqual(service.query_cache.bytes, service.query_cache_bytes)
+
+    def test_streamed_listings(self):
+        # Check streamed JSON and NDJSON output against the buffered listings.
+
+        self.test_app = app.test_client()
+        service.stream_chunk_rows = 2  # Force several chunks.
+        self.addCleanup(setattr, service, 'stream_chunk_rows', 1000)
+        for url in ['/users', '/groups', '/users/query', '/groups/query']:
+            expected = json.loads(self.test_app.get(url).data)
+
+            response = self.test_app.get(url, query_string={'stream': 1})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.headers['content-type'], 'application/json')
+            self.assertEqual(json.loads(response.data), expected)
+
+            response = self.test_app.get(url, headers={'Accept': 'application/x-ndjson'})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.headers['content-type'], 'application/x-ndjson')
+            lines = response.data.decode().splitlines()
+            self.assertEqual([json.loads(line) for line in lines], expected)
+
+    def test_paged_listings(self):
+        # Check limit/offset pages and cursor walks against the full listings.
+
+        self.test_app = app.test_client()
+        for url in ['/users', '/groups', '/users/query', '/groups/query']:
+            expected = json.loads(self.test_app.get(url).data)
+
+            response = self.test_app.get(url, query_string={'offset': 1, 'limit': 2})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(json.loads(response.data), expected[1:3])
+
+            # Walk all pages by cursor.
+            pages = []
+            query = {'limit': 3}
+            while True:
+                response = self.test_app.get(url, query_string=query)
+                self.assertEqual(response.status_code, 200)
+                pages.extend(json.loads(response.data))
+                if 'X-Next-Cursor' not in response.headers:
+                    break
+                query = {'limit': 3, 'cursor': response.headers['X-Next-Cursor']}
+            self.assertEqual(pages, expected)
+
+        # Invalid args.
+        for query in [{'limit': 0}, {'limit': 'asdf'}, {'offset': -1}, {'cursor': 'asdf'}]:
+            response = self.test_app.get('/users', query_string=query)
+            self.assertEqual(response.status_code, 400)
+
+        # Cursor from another file version.
+        stale_cursor = service.encode_cursor(0, -1.0)
+        response = self.test_app.get('/users', query_string={'cursor': stale_cursor})
+        self.assertEqual(response.status_code, 410)
+
+    def test_metrics(self):
+        # Check that /metrics counts requests and exposes file and stage metrics.
+
+        self.test_app = app.test_client()
+        service.time_stages = True
+        self.addCleanup(setattr, service, 'time_stages', False)
+        self.addCleanup(setattr, service, 'query_cache_entries', service.query_cache_entries)
+        service.query_cache_entries = 0  # Time the query stages on every request.
+        self.test_app.get('/users/query', query_string={'shell': '/bin/sh'})
+        before = self.metric_value('paas_requests_total{route="/users",method="GET",status="200"}')
+        self.test_app.get('/users')
+        after = self.metric_value('paas_requests_total{route="/users",method="GET",status="200"}')
+        self.assertEqual(after, before + 1)
+
+        response = self.test_app.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.headers['content-type'].startswith('text/plain'))
+        text = response.data.decode()
+        self.assertIn('paas_request_duration_seconds_count{route="/users"}', text)
+        self.assertIn('paas_file_checks_total{file="users",result="unchanged"}', text)
+        self.assertIn('paas_stage_duration_seconds_count{stage="query_filter"}', text)
+        self.assertTrue(self.metric_value('paas_rows{file="users"}') > 0)
+
+    def test_profiles(self):
+        # Check that requests are profiled only with the admin token, or when sampled, and can be downloaded.
+
+        self.test_app = app.test_client()
+        self.addCleanup(setattr, service, 'profiles', service.profiles)
+        self.addCleanup(setattr, service, 'profile_sample_rate', service.profile_sample_rate)
+        self.addCleanup(setattr, service, 'profile_token', service.profile_token)
+        service.profiles = service.deque(maxlen=2)
+
+        # Off until a token is set.
+        self.assertNotIn('X-Profile-Id', self.test_app.get('/users', headers={'X-Profile': 'secret'}).headers)
+        self.assertEqual(self.test_app.get('/profiles', headers={'X-Profile': 'secret'}).status_code, 404)
+
+        service.profile_token = 'secret'
+        self.assertNotIn('X-Profile-Id', self.test_app.get('/users').headers)
+        self.assertEqual(self.test_app.get('/users', headers={'X-Profile': 'wrong'}).status_code, 403)
+        self.assertEqual(self.test_app.get('/profiles').status_code, 403)
+        response = self.test_app.get('/users/query?shell=/bin/sh', headers={'X-Profile': 'secret'})
+        self.assertEqual(response.status_code, 200)
+        profile_id = response.headers['X-Profile-Id']
+
+        # Summaries list the newest first, without the stacks.
+        summaries = json.loads(self.test_app.get('/profiles', headers={'X-Profile': 'secret'}).data)
+        self.assertEqual([summary['id'] for summary in summaries], [int(profile_id)])
+        self.assertEqual(summaries[0]['path'], '/users/query?shell=/bin/sh')
+        self.assertEqual(set(summaries[0]['functions']), set(service.profile_functions))
+        response = self.test_app.get('/profiles/' + profile_id, headers={'X-Profile': 'secret'})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.headers['content-type'].startswith('text/plain'))
+        self.assertIn('attachment', response.headers['Content-Disposition'])
+        self.assertEqual(self.test_app.get('/profiles/0', headers={'X-Profile': 'secret'}).status_code, 404)
+
+        # Sampled requests need no header; the ring buffer keeps the newest.
+        service.profile_sample_rate = 1.0
+        ids = [self.test_app.get('/users/' + str(dummy_user)).headers['X-Profile-Id'] for _ in range(3)]
+        summaries = json.loads(self.test_app.get('/profiles', headers={'X-Profile': 'secret'}).data)
+        self.assertEqual([str(summary['id']) for summary in summaries], ids[:0:-1])
+
+    def test_profiles_concurrent(self):
+        # Check that profiles can be listed and downloaded while other requests add them.
+
+        self.test_app = app.test_client()
+        self.addCleanup(setattr, service, 'profiles', service.profiles)
+        self.addCleanup(setattr, service, 'profile_sample_rate', service.profile_sample_rate)
+        self.addCleanup(setattr, service, 'profile_token', service.profile_token)
+        service.profiles = service.deque(maxlen=5)
+        service.profile_token = 'secret'
+        service.profile_sample_rate = 1.0
+        failures = []
+        done = threading.Event()
+
+        def get_user():
+            client = app.test_client()
+            while not done.is_set():
+                response = client.get('/users/' + str(dummy_user))
+                if response.status_code != 200:
+                    failures.append(response.status_code)
+
+        writers = [threading.Thread(target=get_user) for _ in range(4)]
+        for writer in writers:
+            writer.start()
+        for _ in range(200):
+            response = self.test_app.get('/profiles', headers={'X-Profile': 'secret'})
+            if response.status_code != 200:
+                failures.append(response.status_code)
+                continue
+            for summary in json.loads(response.data)[-1:]:
+                response = self.test_app.get('/profiles/' + str(summary['id']), headers={'X-Profile': 'secret'})
+                if response.status_code not in (200, 404):  # The oldest may have been pushed out meanwhile.
+                    failures.append(response.status_code)
+        done.set()
+        for writer in writers:
+            writer.join()
+        self.assertEqual(failures, [])
+
+    def test_profile_sampler(self):
+        # Check that the sampler counts collapsed stacks of the thread it samples.
+
+        sampler = service.ProfileSampler(threading.get_ident(), 0.001)
+        sampler.start()
+        deadline = time.perf_counter() + 0.2
+        while time.perf_counter() < deadline:
+            sum(range(1000))
+        sampler.stop()
+        sampler.stop()  # Stopping twice is harmless.
+        self.assertTrue(sampler.stacks)
+        self.assertGreater(sampler.duration, 0.2)
+        self.assertTrue(all('test_all.py:test_profile_sampler' in stack for stack in sampler.stacks))
+
+    def test_admission_control(self):
+        # Check that expensive routes are shed with 503 while the limiter is full, and point lookups are not.
+
+        self.test_app = app.test_client()
+        for name in ['admission_capacity', 'admission_timeout']:
+            self.addCleanup(setattr, service, name, getattr(service, name))
+        service.admission_capacity = 4
+        service.admission_timeout = 0.05
+        taken = service.admission_limiter.acquire(4)
+        self.assertEqual(taken, 4)
+        try:
+            response = self.test_app.get('/users')
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response.headers['Retry-After'], str(service.shed_retry_after))
+            self.assertEqual(self.test_app.get('/groups/query?gid=0').status_code, 503)
+            self.assertEqual(self.test_app.get('/users/' + str(dummy_user)).status_code, 200)
+            text = self.test_app.get('/metrics').data.decode()
+            self.assertIn('paas_admission_shed_total{route="/users"}', text)
+            self.assertIn('paas_admission_in_use 4', text)
+        finally:
+            service.admission_limiter.release(taken)
+        self.assertEqual(self.test_app.get('/users').status_code, 200)
+        self.assertEqual(service.admission_limiter.in_use, 0)
+
+        # Off with no capacity.
+        service.admission_capacity = 0
+        taken = service.admission_limiter.acquire(4)
+        try:
+            self.assertEqual(self.test_app.get('/users').status_code, 200)
+        finally:
+            service.admission_limiter.release(taken)
+
+    def test_admission_streamed(self):
+        # Check that a streamed response holds its capacity until it has been sent and closed.
+
+        self.test_app = app.test_client()
+        self.addCleanup(setattr, service, 'admission_capacity', service.admission_capacity)
+        service.admission_capacity = 4
+        requests = [('/users/query?uid_gte=0&stream=1', {}, service.route_costs['/users/query']),
+                    ('/users', {'Accept': 'application/x-ndjson'}, service.route_costs['/users'])]
+        for path, headers, cost in requests:
+            response = self.test_app.get(path, headers=headers, buffered=False)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(service.admission_limiter.in_use, cost, path)
+            self.assertTrue(response.get_data())
+            response.close()
+            self.assertEqual(service.admission_limiter.in_use, 0, path)
+
+        # Unstreamed responses give it back at once.
+        self.test_app.get('/users/query?uid_gte=0', buffered=False).close()
+        self.assertEqual(service.admission_limiter.in_use, 0)
+
+    def test_admission_queue(self):
+        # Check that waiting requests are admitted in arrival order when capacity frees, and shed past the queue.
+
+        for name in ['admission_capacity', 'admission_timeout', 'admission_queue_length']:
+            self.addCleanup(setattr, service, name, getattr(service, name))
+        service.admission_capacity = 2
+        service.admission_timeout = 5.0
+        service.admission_queue_length = 2
+        limiter = service.AdmissionLimiter()
+        self.assertEqual(limiter.acquire(2), 2)
+
+        # Two waiters queue, a third is shed at once.
+        admitted = []
+        waiters = [threading.Thread(target=lambda cost=cost: admitted.append(limiter.acquire(cost)))
+                   for cost in [2, 1]]
+        for waiter in waiters:
+            waiter.start()
+            while len(limiter.queue) < waiters.index(waiter) + 1:
+                time.sleep(0.001)
+        self.assertEqual(limiter.acquire(1), 0)
+
+        limiter.release(2)
+        waiters[0].join(5)
+        self.assertEqual(admitted, [2])  # The cost 1 waiter doesn't overtake.
+        limiter.release(2)
+        waiters[1].join(5)
+        self.assertEqual(admitted, [2, 1])
+        limiter.release(1)
+        self.assertEqual((limiter.in_use, len(limiter.queue)), (0, 0))
+
+        # Waits end at the timeout.
+        service.admission_timeout = 0.01
+        limiter.acquire(2)
+        self.assertEqual(limiter.acquire(1), 0)
+        self.assertEqual(len(limiter.queue), 0)
+
+    def test_users_batch(self):
+        # Check batch user lookups against single user lookups.
+
+        self.test_app = app.test_client()
+        users = json.loads(self.test_app.get('/users').data)
+        uids = [user['uid'] for user in users] + [1000000]
+        names = [user['name'] for user in users] + ['no-such-user']
+        response = self.test_app.post('/users/batch', json={'uids': uids, 'names': names, 'asdf': 'fdsa'})
+        self.assertEqual(response.status_code, 200)
+        json_vals = json.loads(response.data)
+        for uid in uids[:-1]:
+            single = json.loads(self.test_app.get('/users/' + str(uid)).data)
+            self.assertEqual(json_vals['uids'][str(uid)], single)
+        self.assertIsNone(json_vals['uids']['1000000'])
+        self.assertIsNone(json_vals['names']['no-such-user'])
+        self.valid_user_data([user for user in json_vals['names'].values() if user is not None], False)
+
+        # Repeated keys are listed once, also when they differ only in type.
+        response = self.test_app.post('/users/batch', json={'uids': [0, '0', 0], 'names': ['root', 'root']})
+        self.assertEqual(response.data.count(b'"0"'), 1)
+        self.assertEqual(response.data.count(b'"root": '), 1)
+        self.assertEqual(json.loads(response.data)['uids']['0']['name'], 'root')
+
+        # Invalid bodies.
+        for body in [None, [], {'uids': 1}, {'names': [{}]}, {'uids': [True]}, {'names': [False]}]:
+            response = self.test_app.post('/users/batch', json=body)
+            self.assertEqual(response.status_code, 400)
+        service.batch_limit = 2
+        self.addCleanup(setattr, service, 'batch_limit', 10000)
+        response = self.test_app.post('/users/batch', json={'uids': [0, 1], 'names': ['root']})
+        self.assertEqual(response.status_code, 413)
+
+    def test_groups_batch(self):
+        # Check batch group lookups against single group and user group lookups.
+
+        self.test_app = app.test_client()
+        groups = json.loads(self.test_app.get('/groups').data)
+        users = json.loads(self.test_app.get('/users').data)
+        gids = [group['gid'] for group in groups]
+        uids = [user['uid'] for user in users] + [1000000]
+        members = [user['name'] for user in users]
+        response = self.test_app.post('/groups/batch', json={'gids': gids, 'uids': uids, 'members': members})
+        self.assertEqual(response.status_code, 200)
+        json_vals = json.loads(response.data)
+        for gid in gids:
+            single = json.loads(self.test_app.get('/groups/' + str(gid)).data)
+            self.assertEqual(json_vals['gids'][str(gid)], single)
+        for uid in uids[:-1]:
+            user_groups = json.loads(self.test_app.get('/users/' + str(uid) + '/groups').data)
+            self.assertEqual(json_vals['uids'][str(uid)], user_groups)
+        self.assertIsNone(json_vals['uids']['1000000'])
+        for member in members:
+            query = json.loads(self.test_app.get('/groups/query', query_string={'member': member}).data)
+            self.assertEqual(json_vals['members'][member], query)
+
+    def test_conditional_requests(self):
+        # Check ETag, Last-Modified and 304 responses.
+
+        self.test_app = app.test_client()
+        for url in ['/users', '/users/0', '/users/0/groups', '/users/query?shell=/bin/sh',
+                    '/groups', '/groups/0', '/groups/query?member=root']:
+            response = self.test_app.get(url)
+            self.assertEqual(response.status_code, 200)
+            etag = response.headers['ETag']
+            self.assertIn('Last-Modified', response.headers)
+            self.assertIn('Cache-Control', response.headers)
+
+            response = self.test_app.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.data, b'')
+            self.assertEqual(response.headers['ETag'], etag)
+
+            response = self.test_app.get(url, headers={'If-None-Match': '"other"'})
+            self.assertEqual(response.status_code, 200)
+
+            response = self.test_app.get(url, headers={'If-Modified-Since': 'Sun, 18 Oct 2099 00:00:00 GMT'})
+            self.assertEqual(response.status_code, 304)
+            response = self.test_app.get(url, headers={'If-Modified-Since': 'Thu, 01 Jan 1970 00:00:00 GMT'})
+            self.assertEqual(response.status_code, 200)
+
+        # ETag depends on querystring args and Accept header, not arg order.
+        etag = self.test_app.get('/users/query?shell=/bin/sh&name=root').headers['ETag']
+        self.assertEqual(self.test_app.get('/users/query?name=root&shell=/bin/sh').headers['ETag'], etag)
+        self.assertNotEqual(self.test_app.get('/users/query?shell=/bin/sh').headers['ETag'], etag)
+        ndjson = self.test_app.get('/users', headers={'Accept': 'application/x-ndjson'})
+        self.assertNotEqual(ndjson.headers['ETag'], self.test_app.get('/users').headers['ETag'])
+
+        # Only responses that would be 200 become 304.
+        future = {'If-Modified-Since': 'Sun, 18 Oct 2099 00:00:00 GMT'}
+        cursor = service.encode_cursor(0, 1.0)
+        for url, status in [('/users/1000000', 404), ('/users/1000000/groups', 404), ('/groups/999999', 404),
+                            ('/users?limit=0', 400), ('/users?offset=x', 400), ('/groups?cursor=x', 400),
+                            ('/users/query?uid_gt=x', 400), ('/users/query?name_regex=(', 400),
+                            ('/groups/query?gid_lt=x', 400), ('/users/0/groups?limit=0', 304),
+                            ('/users?expand=members', 400), ('/users?cursor=' + cursor, 410)]:
+            self.assertEqual(self.test_app.get(url, headers=future).status_code, status, url)
+            self.assertEqual(self.test_app.get(url).status_code, 200 if status == 304 else status, url)
+        self.assertEqual(self.test_app.get('/users?limit=1', headers=future).status_code, 304)
+
+        # Not cached.
+        self.assertNotIn('ETag', self.test_app.get('/metrics').headers)
+        self.assertNotIn('ETag', self.test_app.post('/users/batch', json={'uids': [0]}).headers)
+        self.assertNotIn('ETag', self.test_app.get('/users/1000000').headers)
+
     # Methods below are called by testing methods above.
 
+    def user_groups(self, user, groups, primary):
+        # Return the groups listing the user as a member, plus the group of their gid if primary.
+
+        return [group for group in groups
+                if user['name'] in group['members'] or primary and group['gid'] == user['gid']]
+
+    def decompress(self, encoding, data):
+        # Returns data decompressed from a content encoding.
+
+        return gzip.decompress(data) if encoding == 'gzip' else service.brotli.decompress(data)
+
+    def metric_value(self, name):
+        # Returns the value of one metric line from /metrics, 0 if not present.
+
+        for line in app.test_client().get('/metrics').data.decode().splitlines():
+            if line.startswith(name + ' '):
+                return float(line.split(' ')[-1])
+        return 0
+
     def valid_json(self, data):
         # Tests for valid json.
 
@@ -392,3 +1083,510 @@ class TestService(unittest.TestCase):
         else:
             for group in data:
                 self.assertEqual(list(group.keys()), group_cols_output)
+
+
+class TestFileReload(unittest.TestCase):
+    # Tests that run against temporary copies of the included passwd and group files.
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.user_file = os.path.join(self.temp_dir, 'passwd')
+        self.group_file = os.path.join(self.temp_dir, 'group')
+        etc_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'etc')
+        shutil.copy(os.path.join(etc_dir, 'passwd'), self.user_file)
+        shutil.copy(os.path.join(etc_dir, 'group'), self.group_file)
+        service.user_path = self.user_file
+        service.group_path = self.group_file
+        self.test_app = app.test_client()
+
+    def tearDown(self):
+        service.stop_watcher()
+        service.user_path = None
+        service.group_path = None
+        service.index_cache_dir = None
+        service.user_snapshot = service.Snapshot()
+        service.group_snapshot = service.Snapshot()
+        service.sources_dir = None
+        for name in list(service.sources):
+            service.remove_source(name)
+        shutil.rmtree(self.temp_dir)
+
+    def test_reload_on_request(self):
+        # Check that file changes show up without the watcher.
+
+        count = len(json.loads(self.test_app.get('/users').data))
+        self.append_user('newuser:x:5000:100:New User:/home/newuser:/bin/sh')
+        self.assertEqual(len(json.loads(self.test_app.get('/users').data)), count + 1)
+        self.assertEqual(self.test_app.get('/users/5000').status_code, 200)
+
+    def test_output_types(self):
+        # Check that only uid and gid are numbers, however the other fields look.
+
+        self.append_user('100:x:5000:100:42:/home/100:/bin/sh')
+        with open(self.group_file, 'a') as group:
+            group.write('7:x:5000:100\n')
+        user = json.loads(self.test_app.get('/users/5000').data)
+        self.assertEqual(user, {'name': '100', 'uid': 5000, 'gid': 100, 'comment': '42', 'home': '/home/100',
+                                'shell': '/bin/sh'})
+        group = json.loads(self.test_app.get('/groups/5000').data)
+        self.assertEqual(group, {'name': '7', 'gid': 5000, 'members': ['100']})
+        self.assertEqual(json.loads(self.test_app.get('/users/query?name=100').data), [user])
+
+    def test_etag_changes_on_reload(self):
+        # Check that a file change gives a new ETag and ends 304 responses.
+
+        etag = self.test_app.get('/users/0').headers['ETag']
+        group_etag = self.test_app.get('/groups/0').headers['ETag']
+        self.append_user('newuser:x:5000:100:New User:/home/newuser:/bin/sh')
+        response = self.test_app.get('/users/0', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+        response = self.test_app.get('/groups/0', headers={'If-None-Match': group_etag})
+        self.assertEqual(response.status_code, 304)
+
+    def test_query_cache_reload(self):
+        # Check that a file change drops the cached query results made from the old file.
+
+        service.query_cache = service.QueryCache()
+        query = {'shell': '/bin/sh'}
+        count = len(json.loads(self.test_app.get('/users/query', query_string=query).data))
+        self.assertEqual(len(service.query_cache.entries), 1)
+        self.append_user('newuser:x:5000:100:New User:/home/newuser:/bin/sh')
+        self.test_app.get('/users')
+        self.assertEqual(len(service.query_cache.entries), 0)
+        self.assertEqual(len(json.loads(self.test_app.get('/users/query', query_string=query).data)), count + 1)
+
+    def test_change_feed(self):
+        # Check that the change feeds return rows added, modified and removed since a version.
+
+        version = int(self.test_app.get('/users').headers['X-Users-Version'])
+        response = self.test_app.get('/users/changes?since={0}'.format(version))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data), {'version': version, 'added': [], 'modified': [], 'removed': []})
+
+        with open(self.user_file) as passwd:
+            lines = passwd.read().splitlines()
+        removed_name = lines[0].split(':')[0]
+        modified_name = lines[1].split(':')[0]
+        lines = [lines[1] + 'x'] + lines[2:]
+        with open(self.user_file, 'w') as passwd:
+            passwd.write('\n'.join(lines) + '\n')
+        os.utime(self.user_file, (time.time() + 5, time.time() + 5))
+        self.assertEqual(self.test_app.get('/users').headers['X-Users-Version'], str(version + 1))
+        self.append_user('newuser:x:5000:100:New User:/home/newuser:/bin/sh', 1)
+
+        # Both reloads merged into one set of changes.
+        self.assertEqual(self.test_app.get('/users/5000').headers['X-Users-Version'], str(version + 2))
+        changes = json.loads(self.test_app.get('/users/changes?since={0}'.format(version)).data)
+        self.assertEqual(changes['version'], version + 2)
+        self.assertEqual([user['name'] for user in changes['added']], ['newuser'])
+        self.assertEqual([user['name'] for user in changes['modified']], [modified_name])
+        self.assertTrue(changes['modified'][0]['shell'].endswith('x'))
+        self.assertEqual(changes['removed'], [removed_name])
+
+        # Only the append since the first reload.
+        changes = json.loads(self.test_app.get('/users/changes?since={0}'.format(version + 1)).data)
+        self.assertEqual(([user['name'] for user in changes['added']], changes['modified'], changes['removed']),
+                         (['newuser'], [], []))
+
+        # Versions that aren't logged, and invalid args.
+        self.assertEqual(self.test_app.get('/users/changes?since={0}'.format(version + 3)).status_code, 410)
+        self.assertEqual(self.test_app.get('/users/changes?since=1').status_code, 410)
+        self.assertEqual(self.test_app.get('/users/changes').status_code, 400)
+        self.assertEqual(self.test_app.get('/users/changes?since=x').status_code, 400)
+        self.assertEqual(self.test_app.get('/groups/changes?since=0&wait=-1').status_code, 400)
+        group_version = self.test_app.get('/groups').headers['X-Groups-Version']
+        response = self.test_app.get('/groups/changes?since=' + group_version)
+        self.assertEqual(json.loads(response.data)['version'], int(group_version))
+
+    def test_change_feed_wait(self):
+        # Check that a long-polled change request returns once the file changes.
+
+        version = int(self.test_app.get('/users').headers['X-Users-Version'])
+        timer = threading.Timer(0.2, self.append_user, ['newuser:x:5000:100:New User:/home/newuser:/bin/sh'])
+        timer.start()
+        start = time.time()
+        changes = json.loads(self.test_app.get('/users/changes?since={0}&wait=10'.format(version)).data)
+        timer.join()
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(changes['version'], version + 1)
+        self.assertEqual([user['name'] for user in changes['added']], ['newuser'])
+
+        # Times out with no changes.
+        changes = json.loads(self.test_app.get('/users/changes?since={0}&wait=0.1'.format(version + 1)).data)
+        self.assertEqual(changes['added'], [])
+
+    def test_malformed_file(self):
+        # Check that a malformed row gives a server error until it is fixed.
+
+        self.append_user('baduser:x:5000')
+        self.assertEqual(self.test_app.get('/users').status_code, 500)
+        self.assertEqual(self.test_app.get('/users/0').status_code, 500)
+        shutil.copy(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'etc', 'passwd'), self.user_file)
+        os.utime(self.user_file, (time.time() + 10, time.time() + 10))
+        self.assertEqual(self.test_app.get('/users/0').status_code, 200)
+
+    def test_incremental_reload(self):
+        # Check that re-parsing only the changed lines gives the same result as a full parse.
+
+        edits = [
+            lambda lines: lines + ['newuser:x:5000:100:New User:/home/newuser:/bin/sh'],
+            lambda lines: lines[:2] + ['changed:x:5001:100::/tmp:'] + lines[3:],
+            lambda lines: lines[1:],
+            lambda lines: lines[:-1] + [lines[-1] + 'x'],
+            lambda lines: list(reversed(lines)),
+        ]
+        for i, edit in enumerate(edits):
+            with open(self.user_file) as passwd:
+                lines = passwd.read().splitlines()
+            with open(self.user_file, 'w') as passwd:
+                passwd.write('\n'.join(edit(lines)) + '\n')
+            os.utime(self.user_file, (time.time() + 5 + i, time.time() + 5 + i))
+
+            response = self.test_app.get('/users')
+            self.assertEqual(response.status_code, 200)
+            full_rows, _, _ = service.read_rows(self.user_file, service.Snapshot(error=True), service.parse_user_line)
+            self.assertEqual(json.loads(response.data), [row.to_json() for row in full_rows])
+
+        # Malformed line in the changed region.
+        self.append_user('', 10)
+        self.append_user('newuser:x:5000:100:New User:/home/newuser:/bin/sh', 11)
+        self.assertEqual(self.test_app.get('/users').status_code, 500)
+
+    def test_reload_during_reads(self):
+        # Check that concurrent readers only ever see whole file versions during reloads.
+
+        count = len(json.loads(self.test_app.get('/users').data))
+        service.start_watcher(0.01, False)
+        failures = []
+
+        def read_users():
+            client = app.test_client()
+            for _ in range(200):
+                response = client.get('/users')
+                users = json.loads(response.data) if response.status_code == 200 else None
+                if users is None or (len(users) - count) not in range(11):
+                    failures.append(response.status_code)
+
+        readers = [threading.Thread(target=read_users) for _ in range(4)]
+        for reader in readers:
+            reader.start()
+        for i in range(10):
+            self.append_user('newuser{0}:x:{1}:100::/home/newuser:/bin/sh'.format(i, 5000 + i), i)
+            time.sleep(0.02)
+        for reader in readers:
+            reader.join()
+        self.assertEqual(failures, [])
+
+    def test_snapshot_file(self):
+        # Check that a snapshot mapped from a binary snapshot file serves the same responses.
+
+        paths = ['/users', '/users/0', '/users/0/groups', '/users/query?shell=/bin/sh', '/users/query?name=root',
+                 '/groups', '/groups/0', '/groups/query?member=root', '/users?limit=2', '/users/1000000']
+        expected = [self.test_app.get(path) for path in paths]
+        for kind, snapshot in [('users', service.user_snapshot), ('groups', service.group_snapshot)]:
+            file_name = os.path.join(self.temp_dir, kind + '.snapshot')
+            service.write_snapshot_file(snapshot, file_name, kind, note='test')
+            mapped = service.map_snapshot_file(file_name)
+            self.assertEqual((mapped.file_time, mapped.version, mapped.meta), (snapshot.file_time, snapshot.version,
+                                                                               {'note': 'test'}))
+            self.assertEqual([row.to_json() for row in mapped.rows], [row.to_json() for row in snapshot.rows])
+            self.assertEqual(service.diff_snapshots(snapshot, mapped), {})
+            if kind == 'users':
+                service.user_snapshot = mapped
+            else:
+                service.group_snapshot = mapped
+
+        service.start_watcher(30, False)  # Keep requests from reloading the files.
+        for path, response in zip(paths, expected):
+            mapped_response = self.test_app.get(path)
+            self.assertEqual((mapped_response.status_code, mapped_response.data), (response.status_code, response.data))
+            self.assertEqual(mapped_response.headers.get('ETag'), response.headers.get('ETag'))
+
+        # Not a snapshot file.
+        with self.assertRaises(ValueError):
+            service.map_snapshot_file(self.user_file)
+
+    def test_index_cache(self):
+        # Check that a fresh start loads the cached snapshot files, and a changed file is parsed again.
+
+        service.index_cache_dir = os.path.join(self.temp_dir, 'cache')
+        expected = self.test_app.get('/users').data
+        group_expected = self.test_app.get('/users/0/groups').data
+        self.assertEqual(len(os.listdir(service.index_cache_dir)), 2)
+
+        service.user_snapshot = service.Snapshot()
+        service.group_snapshot = service.Snapshot()
+        self.assertEqual(self.test_app.get('/users').data, expected)
+        self.assertEqual(self.test_app.get('/users/0/groups').data, group_expected)
+        self.assertIsInstance(service.user_snapshot, service.MappedSnapshot)
+        self.assertIsInstance(service.group_snapshot, service.MappedSnapshot)
+
+        # A changed file is parsed and cached again.
+        self.append_user('newuser:x:5000:100:New User:/home/newuser:/bin/sh')
+        self.assertEqual(self.test_app.get('/users/5000').status_code, 200)
+        self.assertIsInstance(service.user_snapshot, service.Snapshot)
+        service.user_snapshot = service.Snapshot()
+        self.assertEqual(self.test_app.get('/users/5000').status_code, 200)
+        self.assertIsInstance(service.user_snapshot, service.MappedSnapshot)
+
+        # A broken cache file is ignored.
+        for name in os.listdir(service.index_cache_dir):
+            cache_file_name = os.path.join(service.index_cache_dir, name)
+            with open(cache_file_name, 'rb') as cache_file:
+                data = cache_file.read()
+            with open(cache_file_name + '.new', 'wb') as cache_file:
+                cache_file.write(data[:len(data) // 2])
+            os.replace(cache_file_name + '.new', cache_file_name)  # Don't change the mapped file.
+        service.user_snapshot = service.Snapshot()
+        self.assertEqual(self.test_app.get('/users/5000').status_code, 200)
+        self.assertIsInstance(service.user_snapshot, service.Snapshot)
+
+    def test_prefork(self):
+        # Check that pre-forked workers serve the loader's snapshots and pick up file changes.
+
+        server = subprocess.Popen(
+            [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'prefork.py'),
+             '--port', '0', '--workers', '2', '--passwd', self.user_file, '--group', self.group_file,
+             '--poll-interval', '0.1'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        try:
+            port = int(server.stdout.readline().split()[2].rsplit(b':', 1)[1])
+
+            def get(path):
+                connection = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+                try:
+                    connection.request('GET', path)  # Queued on the socket until a worker has loaded.
+                    response = connection.getresponse()
+                    return response.status, response.read()
+                finally:
+                    connection.close()
+
+            self.assertEqual(get('/users/0'), (200, self.test_app.get('/users/0').data))
+            self.append_user('newuser:x:5000:100:New User:/home/newuser:/bin/sh')
+            deadline = time.time() + 10
+            while get('/users/5000')[0] != 200 and time.time() < deadline:
+                time.sleep(0.05)
+            for _ in range(4):
+                self.assertEqual(get('/users/5000')[0], 200)
+        finally:
+            server.terminate()
+            server.wait(10)
+            server.stdout.close()
+
+    def test_watcher_inotify(self):
+        # Check that the watcher picks up file changes through inotify.
+
+        self.check_watcher(True)
+
+    def test_watcher_polling(self):
+        # Check that the watcher picks up file changes by polling.
+
+        self.check_watcher(False)
+
+    def test_sources(self):
+        # Check that each source serves its own files under /sources/<name>/.
+
+        host_a = self.add_host('host-a')
+        host_b = self.add_host('host-b')
+        with open(os.path.join(host_b, 'passwd'), 'a') as passwd:
+            passwd.write('hostb:x:6000:100:Host B:/home/hostb:/bin/sh\n')
+        self.assertEqual(json.loads(self.test_app.get('/sources').data), ['host-a', 'host-b'])
+
+        # Same data as the main files, and the same routes.
+        for route in ['/users', '/users/0', '/users/query?uid_lt=100', '/groups', '/groups/0', '/users/0/groups']:
+            response = self.test_app.get('/sources/host-a' + route)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(json.loads(response.data), json.loads(self.test_app.get(route).data))
+        self.assertEqual(self.test_app.get('/sources/host-a/users/6000').status_code, 404)
+        self.assertEqual(self.test_app.get('/sources/host-b/users/6000').status_code, 200)
+        self.assertEqual(self.test_app.get('/sources/host-c/users').status_code, 404)
+        self.assertEqual(self.test_app.get('/sources/host-a/metrics').status_code, 404)
+
+        # Rows parsed from identical lines are shared between sources.
+        users_a = service.sources['host-a'].snapshots['users']
+        users_b = service.sources['host-b'].snapshots['users']
+        self.assertIs(users_a.rows[0], users_b.rows[0])
+
+        # A source reloads on its own, with its own version and change feed.
+        version = int(self.test_app.get('/sources/host-a/users').headers['X-Users-Version'])
+        with open(os.path.join(host_a, 'passwd'), 'a') as passwd:
+            passwd.write('hosta:x:6001:100:Host A:/home/hosta:/bin/sh\n')
+        os.utime(os.path.join(host_a, 'passwd'), (time.time() + 5, time.time() + 5))
+        self.assertEqual(self.test_app.get('/sources/host-a/users/6001').status_code, 200)
+        self.assertEqual(self.test_app.get('/users/6001').status_code, 404)
+        changes = json.loads(self.test_app.get('/sources/host-a/users/changes?since={0}'.format(version)).data)
+        self.assertEqual([user['name'] for user in changes['added']], ['hosta'])
+        self.assertIn('paas_rows{file="sources/host-a/users"}', self.test_app.get('/metrics').data.decode())
+
+        # A removed directory removes its source.
+        shutil.rmtree(host_b)
+        self.assertEqual(json.loads(self.test_app.get('/sources').data), ['host-a'])
+        self.assertEqual(self.test_app.get('/sources/host-b/users').status_code, 404)
+
+    def test_user_sources(self):
+        # Check that /users/<uid>/sources returns the user from each source that has the uid.
+
+        self.add_host('host-a')
+        host_b = self.add_host('host-b')
+        with open(os.path.join(host_b, 'passwd'), 'a') as passwd:
+            passwd.write('hostb:x:6000:100:Host B:/home/hostb:/bin/sh\n')
+
+        # The sources are found and loaded by the first request.
+        root = json.loads(self.test_app.get('/users/0').data)
+        self.assertEqual(json.loads(self.test_app.get('/users/0/sources').data), {'host-a': root, 'host-b': root})
+        found = json.loads(self.test_app.get('/users/6000/sources').data)
+        self.assertEqual(list(found), ['host-b'])
+        self.assertEqual(found['host-b']['name'], 'hostb')
+        self.assertEqual(json.loads(self.test_app.get('/users/6001/sources').data), {})
+
+    # Methods below are called by testing methods above.
+
+    def add_host(self, name):
+        # Copy the user and group files into a per-host directory under sources_dir, returning its path.
+
+        service.sources_dir = os.path.join(self.temp_dir, 'hosts')
+        host_dir = os.path.join(service.sources_dir, name)
+        os.makedirs(host_dir)
+        shutil.copy(self.user_file, os.path.join(host_dir, 'passwd'))
+        shutil.copy(self.group_file, os.path.join(host_dir, 'group'))
+
+        return host_dir
+
+    def check_watcher(self, use_inotify):
+        # Start the watcher, change the user file, wait for the new user.
+
+        if use_inotify:
+            inotify_fd = service.open_inotify([self.temp_dir])
+            if inotify_fd is None:
+                self.skipTest('inotify not available')
+            os.close(inotify_fd)
+
+        service.start_watcher(30 if use_inotify else 0.1, use_inotify)
+        self.assertTrue(service.watcher_running())
+        self.assertEqual(self.test_app.get('/users/5000').status_code, 404)
+        self.append_user('newuser:x:5000:100:New User:/home/newuser:/bin/sh')
+        deadline = time.time() + 5
+        while self.test_app.get('/users/5000').status_code != 200 and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(self.test_app.get('/users/5000').status_code, 200)
+
+    def append_user(self, line, version=0):
+        # Append a row to the user file and move its modify time forward.
+
+        with open(self.user_file, 'a') as passwd:
+            passwd.write(line + '\n')
+        os.utime(self.user_file, (time.time() + 5 + version, time.time() + 5 + version))
+
+
+class TestAsgi(unittest.TestCase):
+    # Tests for the ASGI entry point, against temporary copies of the included passwd and group files.
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.user_file = os.path.join(self.temp_dir, 'passwd')
+        self.group_file = os.path.join(self.temp_dir, 'group')
+        etc_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'etc')
+        shutil.copy(os.path.join(etc_dir, 'passwd'), self.user_file)
+        shutil.copy(os.path.join(etc_dir, 'group'), self.group_file)
+        service.user_path = self.user_file
+        service.group_path = self.group_file
+        self.test_app = app.test_client()
+
+    def tearDown(self):
+        service.stop_watcher()
+        service.user_path = None
+        service.group_path = None
+        service.user_snapshot = service.Snapshot()
+        service.group_snapshot = service.Snapshot()
+        shutil.rmtree(self.temp_dir)
+
+    def test_asgi_matches_wsgi(self):
+        # Check that ASGI responses match the Flask app's, on and off the cached fast path.
+
+        self.addCleanup(setattr, service, 'compress_min_size', service.compress_min_size)
+        service.compress_min_size = 0  # Compress even the small included files.
+        self.call_asgi('GET', '/users')
+        self.assertTrue(service.watcher_running())
+        etag = self.test_app.get('/users/0').headers['ETag']
+        last_modified = self.test_app.get('/groups').headers['Last-Modified']
+        gzip_etag = self.test_app.get('/users', headers={'Accept-Encoding': 'gzip'}).headers['ETag']
+        requests = [
+            ('GET', '/users', {}, b''),
+            ('GET', '/groups', {}, b''),
+            ('GET', '/users/0', {}, b''),
+            ('GET', '/users/00', {}, b''),
+            ('GET', '/groups/0', {'Accept': 'application/json'}, b''),
+            ('GET', '/users/0', {'If-None-Match': etag}, b''),
+            ('GET', '/groups', {'If-Modified-Since': last_modified}, b''),
+            ('GET', '/users/1000000', {}, b''),
+            ('GET', '/users', {'Accept': 'application/x-ndjson'}, b''),
+            ('GET', '/users?stream=1', {}, b''),
+            ('GET', '/users?limit=2', {}, b''),
+            ('GET', '/users/query?shell=/bin/sh', {}, b''),
+            ('GET', '/users/0/groups', {}, b''),
+            ('POST', '/users/batch', {'Content-Type': 'application/json'}, b'{"uids": [0, 1000000]}'),
+            ('POST', '/users/batch', {'Content-Type': 'application/json'}, b'[]'),
+            ('GET', '/nowhere', {}, b''),
+            ('GET', '/users', {'Accept-Encoding': 'gzip, deflate'}, b''),
+            ('GET', '/groups', {'Accept': service.columns_mimetype}, b''),
+            ('GET', '/users/0', {'Accept': service.msgpack_mimetype + ', application/json;q=0.5'}, b''),
+            ('GET', '/groups', {'Accept-Encoding': 'br;q=0.5, gzip'}, b''),
+            ('GET', '/users/0', {'Accept-Encoding': 'gzip'}, b''),
+            ('GET', '/users', {'Accept-Encoding': 'gzip', 'If-None-Match': gzip_etag}, b''),
+        ]
+        for method, path, headers, body in requests:
+            status, asgi_headers, asgi_body = self.call_asgi(method, path, headers, body)
+            response = self.test_app.open(path, method=method, headers=headers, data=body)
+            self.assertEqual((status, asgi_body), (response.status_code, response.data), path)
+            self.assertEqual(asgi_headers, {name.lower(): value for name, value in response.headers.items()}, path)
+
+    def test_asgi_reload(self):
+        # Check that file changes show up on the cached fast path.
+
+        self.assertEqual(self.call_asgi('GET', '/users/5000')[0], 404)
+        with open(self.user_file, 'a') as passwd:
+            passwd.write('newuser:x:5000:100:New User:/home/newuser:/bin/sh\n')
+        os.utime(self.user_file, (time.time() + 5, time.time() + 5))
+        service.refresh_users()  # Don't wait for the watcher.
+        status, _, body = self.call_asgi('GET', '/users/5000')
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body)['name'], 'newuser')
+
+    def test_asgi_lifespan(self):
+        # Check that server startup loads the files and starts the watcher, and shutdown stops it.
+
+        messages = [{'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}]
+        sent = []
+
+        async def receive():
+            if messages[0]['type'] == 'lifespan.shutdown':
+                self.assertTrue(service.watcher_running())
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message['type'])
+
+        asyncio.run(asgi.app({'type': 'lifespan'}, receive, send))
+        self.assertEqual(sent, ['lifespan.startup.complete', 'lifespan.shutdown.complete'])
+        self.assertFalse(service.watcher_running())
+        self.assertIsNotNone(service.user_snapshot.file_time)
+
+    # Methods below are called by testing methods above.
+
+    def call_asgi(self, method, path, headers=None, body=b''):
+        # Send one request to the ASGI app, return (status, headers, body).
+
+        return asyncio.run(benchmark.call_asgi(method, path, headers or {}, body))
+
+
+class TestBenchmark(unittest.TestCase):
+    # Smoke test for the benchmark script.
+
+    def test_benchmark_runs(self):
+        # Run a tiny benchmark through the in-process and WSGI targets and compare it against itself.
+
+        results = benchmark.run(50, 10, 5, 2, 2, ['test_client', 'wsgi', 'asgi'], out=io.StringIO())
+        routes = benchmark.get_routes(50, 10)
+        self.assertEqual(len(results['routes']), 3 * len(routes))
+        self.assertTrue(results['peak_rss_mb'] > 0)
+        self.assertEqual(benchmark.compare(results, results, 0.2), [])